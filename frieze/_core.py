@@ -9,6 +9,7 @@ __all__ = [
     'Deployment',
     'Container',
     'RoleACL',
+    'TopologyBatch',
     'set_domain'
 ]
 
@@ -16,15 +17,13 @@ import base64
 import collections
 import enum
 import frieze.capability
-import gevent
 import hashlib
 import io
 import ipaddress
+import json
 import openarc
 import os
-import pkg_resources as pkg
 import pwd
-import shutil
 import subprocess
 import sys
 import tarfile
@@ -37,14 +36,17 @@ from openarc import *
 from openarc.time import OATime
 from openarc.exception import OAGraphRetrieveError, OAError
 
+from frieze.artifact import ArtifactStore
+from frieze.certinfo import CertAction, TrustType
+from frieze.dbstat import SeqScanMonitor
 from frieze.osinfo import HostOS, Tunable, TunableType, OSFamily
 from frieze.provider import CloudProvider, ExtCloud, Location
+from frieze.rollout import RollingDeploy
+from frieze.capability.profile import graph_load, profiled
 from frieze.capability import\
     ConfigGenFreeBSD, ConfigInit, CapabilityTemplate,\
     dhclient as dhc, bird, dhcpd, firstboot, gateway, jail,\
     named, pf, pflog, pflate, resolvconf, zfs
-from frieze.capability.server import\
-    TrustType, CertAction, CertAuthInternal, CertAuthLetsEncrypt, ExtDNS
 
 #### Some enums
 class FIB(enum.Enum):
@@ -101,6 +103,13 @@ nested_dict = lambda: collections.defaultdict(nested_dict)
 # Use this to store cloned oags
 p_clone_buffer = None
 
+# Use this to store derived values of nodes in frozen domains. Keyed by class,
+# then id, then property name and arguments.
+p_frozen_buffer = {}
+
+# Use this to store the innermost active TopologyBatch
+p_topology_batch = None
+
 #### Decorator
 def friezetxn(fn):
     def wrapfn(self, *args, **kwargs):
@@ -110,6 +119,192 @@ def friezetxn(fn):
             return fn(self, *args, **kwargs)
     return wrapfn
 
+def frozenprop(fn):
+    """Memoize derived values of nodes in frozen domains. friezetxn guarantees
+    that frozen domains are never mutated, so nothing needs invalidating."""
+    def wrapfn(self, *args, **kwargs):
+        if not self.root_domain.is_frozen:
+            return fn(self, *args, **kwargs)
+        memo = p_frozen_buffer.setdefault(self.__class__, {}).setdefault(self.id, {})
+        key = (fn.__name__, args, tuple(sorted(kwargs.items())))
+        try:
+            return memo[key]
+        except KeyError:
+            memo[key] = fn(self, *args, **kwargs)
+            return memo[key]
+    return wrapfn
+
+def nodeclass(node):
+    """Return the OAG class of node. Use this instead of type() checks: nodes
+    loaded from a snapshot stand in for their OAG class without inheriting
+    from it."""
+    return getattr(type(node), 'oagclass', type(node))
+
+#### Topology batches
+class TopologyBatch(object):
+    """Defer the second order effects of topology edits (rerouting, dhclient,
+    dhcpd/named/resolvconf and bird reconciliation) until the outermost batch
+    exits, and then run each of them once per host or site instead of once
+    per interface added:
+
+        with TopologyBatch():
+            for i in range(100):
+                site.add_host(template, f'compute{i}', HostRole.COMPUTE)
+
+    Batches nest; inner batches fold their effects into the outermost one.
+
+    Effects take no arguments. A batched effect runs once per node, so it
+    must compute everything from the graph as it stands at commit, not from
+    whichever call happened to record it."""
+
+    # Effects are run in this order on commit
+    effects = [
+        '_reroute_compute_hosts',
+        '_reconcile_dhclients',
+        '_reconcile_site_services',
+        '_enable_bird',
+    ]
+
+    def __init__(self):
+        self.outer   = None
+        self.pending = collections.OrderedDict()
+
+    def __enter__(self):
+        global p_topology_batch
+        self.outer = p_topology_batch
+        if not self.outer:
+            p_topology_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global p_topology_batch
+        if not self.outer:
+            p_topology_batch = None
+            if not exc_type:
+                self.commit()
+
+    def commit(self):
+        pending, self.pending = self.pending, collections.OrderedDict()
+        for effect in self.effects:
+            for (cls, id_, effect_) in pending:
+                if effect_==effect:
+                    getattr(cls(id_), effect)()
+
+    def record(self, node, effect):
+        """Queue effect to be run on node at commit. Nodes are reloaded by id,
+        so it is safe to pass cursors. Repeated effects on the same node are
+        run once."""
+        if effect not in self.effects:
+            raise OAError(f"[{effect}] is not a topology effect")
+        self.pending[(node.__class__, node.id, effect)] = True
+
+def topology_effect(node, effect):
+    """Run effect on node now, or at commit if a TopologyBatch is active"""
+    if p_topology_batch:
+        p_topology_batch.record(node, effect)
+    else:
+        getattr(node, effect)()
+
+def allocate_subnet(type_, existing_subnets, hosts_expected=254, seqnum=None):
+    """Return the first network of type_ that fits hosts_expected and doesn't
+    overlap any of existing_subnets. Deployment networks are carved out of
+    the deployment's own /16, numbered by seqnum."""
+
+    # Calculate smallest possible prefix that can accommodate number of
+    # hosts expected.
+    def hosts_to_prefix(hostcount, prefix__=8):
+        while hostcount<=pow(2, 32-prefix__)-2:
+            prefix__+=1
+        return prefix__-1
+
+    prefixlen = hosts_to_prefix(hosts_expected)
+
+    if type_ in (SubnetType.ROUTING, SubnetType.SITE):
+        root_network    = '172.16.0.0'
+        root_prefixlen  =  12
+    else:
+        root_network    = '10.%d.0.0' % seqnum
+        root_prefixlen  =  16
+
+    root_subnet = ipaddress.IPv4Network('%s/%s' % (root_network, root_prefixlen))
+
+    # How many of subnets sized prefixlen are there in root_subnet
+    candidate_subnets = root_subnet.subnets(prefixlen_diff=prefixlen-root_prefixlen)
+
+    for csubnet in candidate_subnets:
+        overlap_found = False
+        for esub in existing_subnets:
+            if csubnet.overlaps(esub):
+                overlap_found = True
+        if not overlap_found:
+            break
+
+    # Degenerate case: we don't have any subnets left
+    if overlap_found:
+        raise OAError("Subnet exhaustion")
+
+    return csubnet
+
+class OAGView(object):
+    """Read-only filtered view over an OAG collection. Unlike clone().rdf.filter()
+    the collection is never refiltered: matching rows are found once, on first
+    use. The view never moves the cursor of the collection it is built on.
+    Each iteration walks a clone of its own and indexing returns standalone
+    nodes, so views can be nested and indexed inside loops over themselves."""
+    def __init__(self, collection, predicate, rows=None):
+        """With no predicate, rows are the matches"""
+        self._collection = collection
+        self._predicate  = predicate
+        self._rows       = rows
+        self._matches    = None
+
+    def __bool__(self):
+        return self.size>0
+
+    def __getitem__(self, idx):
+        return self.node(idx)
+
+    def __iter__(self):
+        if self.matches:
+            collection = self._collection.clone()
+            for row in self.matches:
+                yield collection[row]
+
+    def __len__(self):
+        return self.size
+
+    def clone(self):
+        return self
+
+    def filter(self, predicate):
+        return OAGView(self._collection, predicate, rows=self.matches)
+
+    @property
+    def matches(self):
+        if self._matches is None:
+            self._matches = []
+            if self._collection:
+                rows = self._rows if self._rows is not None else range(self._collection.size)
+                if self._predicate is None:
+                    self._matches = list(rows)
+                else:
+                    collection = self._collection.clone()
+                    self._matches = [row for row in rows if self._predicate(collection[row])]
+        return self._matches
+
+    def node(self, idx):
+        """Return a standalone node for the idx-th match, safe to hold on to
+        while the underlying collection is iterated elsewhere"""
+        return self._collection.clone()[self.matches[idx]]
+
+    @property
+    def rdf(self):
+        return self
+
+    @property
+    def size(self):
+        return len(self.matches)
+
 class OAG_FriezeRoot(OAG_RootNode):
     @staticproperty
     def streamable(self): return False
@@ -132,6 +327,20 @@ class OAG_FriezeRoot(OAG_RootNode):
     def root_domain(self, **kwargs):
         return self.walk_graph_to_domain(self)[-1]
 
+    def prefetched(self, stream, refresh=False, copy=True):
+        """Return the payload of stream, optionally from a fresh copy of the
+        node. Nodes of versions loaded by OAG_Domain.prefetch() serve this
+        from memory. Unless copy is False, the caller gets a private copy it
+        is free to filter."""
+        graph_load()
+        node = self
+        if refresh:
+            node = self.clone()
+            node.db.search()
+            node = node[-1]
+        payload = getattr(node, stream, None)
+        return payload.clone() if payload and copy else payload
+
     def db_clone_with_changes(self, src, repl={}):
 
         global p_clone_buffer
@@ -269,7 +478,7 @@ class OAG_Capability(OAG_FriezeRoot):
 
     @property
     def c_capability(self):
-        return getattr(frieze.capability, self.service, None)
+        return frieze.capability.lookup(self.service)
 
     def rc_delete(self):
         self.start_rc = None
@@ -284,17 +493,20 @@ class OAG_Capability(OAG_FriezeRoot):
         self.db.update()
 
     @property
+    @frozenprop
     def fqdn(self):
         return f"{self.name}.{self.deployment.name}.{self.deployment.domain.domain}"
 
     @property
     def fqdn_ext(self):
-        if self.capability_alias and self.capability_alias.is_external:
-            return self.capability_alias.fqdn
+        capability_alias = self.prefetched('capability_alias')
+        if capability_alias and capability_alias.is_external:
+            return capability_alias.fqdn
         else:
             return None
 
     @property
+    @frozenprop
     def fqdn_stripe(self):
         return f'{self.stripe_group}.{self.deployment.name}.{self.deployment.domain.domain}'
 
@@ -314,10 +526,12 @@ class OAG_Capability(OAG_FriezeRoot):
     def slot_factor(self):
         return (self.cores if self.cores else 0.25) * (self.memory if self.memory else 256)
 
+    @frozenprop
     def truststore(self, pubkey=True, internal=False):
         """Return directory where certificates related to this capability are stored on disk"""
-        if self.capability_alias and self.capability_alias.is_external:
-            aliases = [ca.fqdn for ca in self.capability_alias]
+        capability_alias = self.prefetched('capability_alias')
+        if capability_alias and capability_alias.is_external:
+            aliases = [ca.fqdn for ca in capability_alias]
         else:
             aliases = [self.fqdn]
 
@@ -351,6 +565,7 @@ class OAG_CapabilityAlias(OAG_FriezeRoot):
     }
 
     @property
+    @frozenprop
     def fqdn(self):
         return f'{self.alias}.{self.capability.deployment.domain.domain}' if self.alias else self.capability.deployment.domain.domain
 
@@ -436,7 +651,7 @@ class OAG_Container(OAG_FriezeRoot):
 
     @property
     def block_storage(self):
-        return OAG_SysMount() if self.site.block_storage.size==0 else self.site.block_storage.clone().rdf.filter(lambda x: x.container_name==self.fqdn)
+        return OAGView(self.site.block_storage, lambda x: x.container_name==self.fqdn)
 
     @property
     def configprovider(self):
@@ -445,7 +660,8 @@ class OAG_Container(OAG_FriezeRoot):
         }[self.host.os.family](self)
 
     def configure(self, targetdir=None):
-        return ConfigInit(self.configprovider.intermediate_representation).generate(targetdir=targetdir)
+        with profiled(rununit=self.fqdn) as p:
+            return p.output(ConfigInit.from_provider(self.configprovider).generate(targetdir=targetdir))
 
     def dataset(self, layer, mountpoint=False):
         dsname = {
@@ -608,7 +824,7 @@ class OAG_Deployment(OAG_FriezeRoot):
 
     @property
     def containers(self):
-        return self.domain.containers.clone().rdf.filter(lambda x: x.deployment.id==self.id)
+        return OAGView(self.domain.containers, lambda x: x.deployment.id==self.id)
 
     @property
     def revzone(self):
@@ -689,9 +905,10 @@ class OAG_Domain(OAG_FriezeRoot):
                     'name'      : name
                 })
 
-            for site in self.site:
-                for host in site.host:
-                    host.add_iface(depl.vlan, False, hostiface=host.internal_ifaces[0], type_=NetifType.VLAN, deployment=depl)
+            with TopologyBatch():
+                for site in self.site:
+                    for host in site.host:
+                        host.add_iface(depl.vlan, False, hostiface=host.internal_ifaces.node(0), type_=NetifType.VLAN, deployment=depl)
 
         return depl
 
@@ -732,45 +949,19 @@ class OAG_Domain(OAG_FriezeRoot):
 
     @friezetxn
     def assign_subnet(self, type_, hosts_expected=254, iface=None, dynamic_hosts=0, deployment=None):
-
-
-        # Calculate smallest possible prefix that can accommodate number of
-        # hosts expected.
-        def hosts_to_prefix(hostcount, prefix__=8):
-            while hostcount<=pow(2, 32-prefix__)-2:
-                prefix__+=1
-            return prefix__-1
-
-        prefixlen = hosts_to_prefix(hosts_expected)
-
-        if type_ in (SubnetType.ROUTING, SubnetType.SITE):
-            root_network    = '172.16.0.0'
-            root_prefixlen  =  12
-        else:
-            root_network    = '10.%d.0.0' % deployment.seqnum
-            root_prefixlen  =  16
-
-        root_subnet = ipaddress.IPv4Network('%s/%s' % (root_network, root_prefixlen))
-
-        # How many of subnets sized prefixlen are there in root_subnet
-        candidate_subnets = root_subnet.subnets(prefixlen_diff=prefixlen-root_prefixlen)
         existing_subnets = []
         try:
             existing_subnets = [esub.ip4network for esub in self.subnet.rdf.filter(lambda x: x.type==type_)]
         except AttributeError:
             pass
 
-        for csubnet in candidate_subnets:
-            overlap_found = False
-            for esub in existing_subnets:
-                if csubnet.overlaps(esub):
-                    overlap_found = True
-            if not overlap_found:
-                break
-
-        # Degenerate case: we don't have any subnets left
-        if overlap_found:
-            raise OAError("Subnet exhaustion")
+        csubnet =\
+            allocate_subnet(
+                type_,
+                existing_subnets,
+                hosts_expected=hosts_expected,
+                seqnum=deployment.seqnum if deployment else None
+            )
 
         self.db.search()
 
@@ -786,6 +977,7 @@ class OAG_Domain(OAG_FriezeRoot):
             })
 
     def trust(self, trust_type=TrustType.INTERNAL):
+        from frieze.capability.server import CertAuthInternal, CertAuthLetsEncrypt
         return {
             TrustType.INTERNAL    : CertAuthInternal,
             TrustType.LETSENCRYPT : CertAuthLetsEncrypt
@@ -798,13 +990,14 @@ class OAG_Domain(OAG_FriezeRoot):
 
         def init_resource_matrix():
             rmatrix = {}
-            for site in self.site:
+            for site in self.prefetched('site'):
                 try:
                     rmatrix[site.shortname]
                 except KeyError:
                     rmatrix[site.shortname] = {}
 
-                for i, host in enumerate(site.compute_hosts):
+                compute_hosts = site.compute_hosts
+                for i, host in enumerate(compute_hosts):
                     try:
                         rmatrix[site.shortname][host.fqdn]
                     except KeyError:
@@ -813,7 +1006,7 @@ class OAG_Domain(OAG_FriezeRoot):
                             'depl_count'       : dict(),
                             # Total number of containers on this host
                             'container_count'  : 0,
-                            'oag'              : host.clone()[i],
+                            'oag'              : compute_hosts.node(i),
                             'slot_factor'      : host.memory * host.cores
                         }
             return rmatrix
@@ -835,12 +1028,12 @@ class OAG_Domain(OAG_FriezeRoot):
         # available, they are not entered in the capability mapping
         containers = [list(OAG_Container.streams.keys())]
         unplaceable_caps = []
-        for depl in self.deployment:
+        for depl in self.prefetched('deployment'):
 
-            if depl.capability:
+            if depl.prefetched('capability'):
 
                 # Place site specific capabilities first
-                caps_with_affinity = depl.capability.clone().rdf.filter(lambda x: x.affinity is not None)
+                caps_with_affinity = depl.prefetched('capability').rdf.filter(lambda x: x.affinity is not None)
                 for cap in caps_with_affinity:
                     site_slot_factor = sum([host['slot_factor'] for hostname, host in rmatrix[cap.affinity.shortname].items()])
                     if site_slot_factor<cap.slot_factor:
@@ -860,7 +1053,7 @@ class OAG_Domain(OAG_FriezeRoot):
                             break
 
                 # Distribute affinity-free resources next
-                caps_without_affinity = depl.capability.clone().rdf.filter(lambda x: x.affinity is None)
+                caps_without_affinity = depl.prefetched('capability').rdf.filter(lambda x: x.affinity is None)
                 for cap in caps_without_affinity:
                     site_loop_break = False
 
@@ -893,22 +1086,29 @@ class OAG_Domain(OAG_FriezeRoot):
 
         return OAG_Container(initprms=containers)
 
-    def deploy(self, push=True, version_name=str()):
+    def deploy(self, push=True, version_name=str(), apply=None):
+        """Render and push this version. With apply='reload' (the default is
+        [deploy] apply in frieze.conf), hosts that already run a frieze
+        configuration apply changes live where they can, instead of rebooting
+        into a new boot environment."""
 
         if not self.is_frozen:
             raise OAError("Can't deploy domain that hasn't been snapshotted")
 
-        oalog.info(f"Deplying snapshot [{self.version_name}]")
+        if not apply:
+            try:
+                apply = oaenv('frieze').deploy.apply
+            except (AttributeError, KeyError):
+                apply = 'reboot'
+        if apply not in ('reboot', 'reload'):
+            raise OAError(f"Unknown apply mode [{apply}]")
 
-        def generate_domain_config():
-            hostcfgs = {}
-            for site in self.site:
-                hostcfgs = {**hostcfgs, **site.configure()}
-            return hostcfgs
+        oalog.info(f"Deplying snapshot [{self.version_name}]")
 
         # If you aren't pushing, just generate the files and return
         if not push:
-            generate_domain_config()
+            for (host, host_tar) in self.iter_configs():
+                pass
             return
 
         # Atomically distribute the cert authority to all sites so that
@@ -930,23 +1130,35 @@ class OAG_Domain(OAG_FriezeRoot):
         # to ensure that files are wiped out after context manager __exit__s.
         with tempfile.TemporaryDirectory() as td:
 
-            # Generate configs
-            hostcfgs = generate_domain_config()
-
-            # SSH credential creation
+            # SSH credential creation. Hosts are rendered, and batches waited
+            # on, while the credential is in use, so it has to outlive the
+            # whole push.
             (id_file, id_file_pub) =\
                 self.trust().issue_certificate(
                     pwd.getpwuid(os.getuid())[0],                       # subject
                     CertAction.HOST_ACCESS_AUTO.desc(
                         info=f'[{self.domain}:{self.version_name}]'
                     ),
+                    validity_length=3600,                               # seconds
                     serialize_to_dir=os.path.join(td, '.ssh')           # where to serialize
                 )
 
-            # get configinit representation, send to host for execution
-            for host, host_tar in hostcfgs.items():
-                remote_address = host.db.search()[-1].ip4(fib=FIB.WORLD)
+            # get configinit representation, send to host for execution. Each
+            # host is pushed as soon as it is rendered; RollingDeploy holds a
+            # host back until the batch before it has come back healthy, so
+            # that every stripe group keeps serving.
+            def push_host(host, host_tar):
+                remote_address = host.ip4(fib=FIB.WORLD)
                 remote_tarfile = f'{host.fqdn}.tar.bz2'
+                boottime = rollout.boottime(host, id_file)
+
+                # Only send what changed since the host's last configinit run
+                applied = host.applied_manifest(id_file)
+                if applied is not None:
+                    full_size = len(host_tar)
+                    host_tar = ConfigInit.delta(host_tar, applied, reload=apply=='reload')
+                    print(f'Delta for {host.fqdn}: {len(host_tar)} of {full_size} bytes')
+
                 cmd = f'ssh root@{remote_address} -i {id_file} "cat > {remote_tarfile} && configinit {remote_tarfile}"'
 
                 print(f'Pushing configuration for: {host.fqdn} ({remote_address})')
@@ -962,19 +1174,101 @@ class OAG_Domain(OAG_FriezeRoot):
                 # We'll need to log output here
                 print(output)
 
+                return (host, boottime, ConfigInit.reboots(host_tar))
+
+            domain = self.prefetch()
+            rollout = RollingDeploy(domain)
+            rollout.run(domain.iter_configs(), push_host, id_file)
+
         # Mark version as deployed
         self.db.update({
             'deployed' : True,
         })
 
+    def iter_configs(self):
+        """Yield (host, configinit tarball) for every host in this version,
+        as each is rendered"""
+        if not self.is_frozen:
+            raise OAError("Can't configure domain that hasn't been snapshotted")
+
+        # Load the version into memory before rendering: everything from
+        # here on is read-only. Versions already in memory return themselves.
+        domain = self.prefetch()
+
+        # Issue external certificates up front, so that rendering trusts
+        # only reads them from disk
+        domain.issue_certificates()
+
+        for site in domain.prefetched('site'):
+            yield from site.iter_configs()
+
+        # Apply retention to rendered versions
+        self.artifacts.gc()
+
+    @property
+    def artifacts(self):
+        """Store of rendered configurations for this domain"""
+        return ArtifactStore(os.path.join(oaenv('frieze').runprops.home, 'domains', self.domain))
+
+    @property
+    def external_alias_sets(self):
+        """Aliases of each capability exposed externally, as certificate subjects"""
+        alias_sets = []
+        for depl in self.prefetched('deployment'):
+            capabilities = depl.prefetched('capability')
+            if not capabilities:
+                continue
+            for cap in capabilities:
+                capability_alias = cap.prefetched('capability_alias')
+                if capability_alias and capability_alias.is_external:
+                    alias_sets.append([ca.fqdn for ca in capability_alias])
+        return alias_sets
+
+    def issue_certificates(self):
+        """Issue external certificates for every capability exposed under an
+        alias in this version, concurrently"""
+        alias_sets = self.external_alias_sets
+        if alias_sets:
+            return self.trust(trust_type=TrustType.LETSENCRYPT).issue_certificates(alias_sets)
+        else:
+            return []
+
     @oagprop
     def extdns(self, **kwargs):
+        from frieze.capability.server import ExtDNS
         return ExtDNS(self)
 
     @property
     def is_frozen(self):
         return len(self.version_name)>0
 
+    def prefetch(self):
+        """Load this version into memory, and return the in-memory domain.
+        Rows are read with one query per table and parent stream, into the
+        same graph load_snapshot() builds from a file, so rendering from it
+        doesn't go back to the database. Call it after cloud enrichment:
+        every call reads the version afresh."""
+        if not self.is_frozen:
+            raise OAError("Can't prefetch domain that hasn't been snapshotted")
+
+        # Optionally flag lookups that fell back to sequential scans. This is
+        # the only place rendering reads from the database.
+        try:
+            check_seqscans = oaenv('frieze').dbcheck.seqscan
+        except (AttributeError, KeyError):
+            check_seqscans = False
+
+        from frieze.snapshot import SnapshotGraph, snapshot_data
+        with SeqScanMonitor(enabled=check_seqscans):
+            data = snapshot_data(self)
+        return SnapshotGraph(data).domain
+
+    def export_snapshot(self, path):
+        """Write this version to path so that it can be rendered without a
+        database. See frieze.snapshot."""
+        from frieze.snapshot import export_snapshot
+        return export_snapshot(self, path)
+
     def snapshot(self, version_prefix=str()):
         if self.version_name:
             raise OAError("This version has already been snapshot with [%s]" % self.version_name)
@@ -1107,18 +1401,12 @@ class OAG_Host(OAG_FriezeRoot):
 
             self.db.search()
 
-            # Don't forget the second order effects:
+            # Don't forget the second order effects. Anything that has to be
+            # recomputed across hosts goes through topology_effect(), which
+            # defers it to commit if a TopologyBatch is active.
             # 1. Rerouting traffic if adding internal interface on bastion
             if iface.type==NetifType.PHYSICAL and self.is_bastion and not iface.is_external:
-                if self.site.compute_hosts:
-                    for host in self.site.compute_hosts:
-                        for i, int_iface in enumerate(host.internal_ifaces):
-                            try:
-                                int_iface.routed_by = self.site.bastion.routed_subnets[i].routing_iface
-                                int_iface.fib = FIB.DEFAULT
-                                int_iface.db.update()
-                            except IndexError:
-                                raise OAError("Unable to find corresponding internal routing interface")
+                topology_effect(self.site, '_reroute_compute_hosts')
                 self.site.domain.assign_subnet(SubnetType.SITE, hosts_expected=1000, iface=iface, dynamic_hosts=100)
 
             # 2. Assign subnets to VLAN that is being created
@@ -1131,79 +1419,80 @@ class OAG_Host(OAG_FriezeRoot):
                 )
 
             # 3. Assign networking capabilities: dhclient to be specific.
-            dhcp_ifaces = self.physical_ifaces.rdf.filter(lambda x: x.routingstyle==RoutingStyle.DHCP)
-            if dhcp_ifaces.size>1 and len(self.fibs)>1:
-
-                # Update previously created dhclient capabilities
-                updated = 0
-                dhclients = self.capability.rdf.filter(lambda x: x.service=='dhclient') if self.capability else []
-                for i, dhclient in enumerate(dhclients):
-                    try:
-                        dhclient.db.update({
-                            'start_rc' : False,
-                            'start_local' : True,
-                            'start_local_prms' : dhcp_ifaces[i].name,
-                            'fib' : self.fibs[updated]
-                        })
-                    except Exception as e:
-                        print(e)
-                        raise
-                    updated += 1
-
-                # Create remaining required dhclients (i.e. for current interface)
-                for i in range(updated, len(self.fibs)):
-                    OAG_Capability().db.create({
-                        'deployment' : deployment,
-                        'host' : self,
-                        'service' : dhc.name,
-                        'stripe' : 0,
-                        'stripe_group' : dhc.name,
-                        'affinity' : None,
-                        'cores' : dhc.cores if dhc.cores else 0,
-                        'memory' : dhc.memory if dhc.memory else 0,
-                        'start_rc' : False,
-                        'start_local' : True,
-                        'start_local_prms' : dhcp_ifaces[i].name,
-                        'fib' : self.fibs[i],
-                        'expose' : False,
-                        'secure' : False,
-                        'custom_pkg' : False,
-                    })
+            topology_effect(self, '_reconcile_dhclients')
 
             # 4. Enable dhcpd on bastion (if it exists) -every- time because each newly added interface
             #    can potentially trigger a dhcpd requirement. Same for named, I guess.
-            if self.site.bastion:
-                bastion = self.site.bastion
-
-                # DHCP
-                try:
-                    cap_dhcpd = bastion.capability.rdf.filter(lambda x: x.service=='dhcpd') if bastion.capability else bastion.capability
-                except AttributeError:
-                    cap_dhcpd = None
-                dhcpd_ifaces = ' '.join([iface.name for iface in bastion.internal_ifaces if iface.dhcpd_enabled])
-                if not cap_dhcpd:
-                    dhcpd_capdef = dhcpd().setknob('ifaces', dhcpd_ifaces)
-                    bastion.add_capability(dhcpd_capdef, enable_state=True)
-                else:
-                    dhcpd_iface_knob = cap_dhcpd.capability_knob.rdf.filter(lambda x: x.knob=='ifaces')
-                    if dhcpd_ifaces != dhcpd_iface_knob.value:
-                        dhcpd_iface_knob.db.update({
-                            'value' : dhcpd_ifaces
-                        })
-
-                # DNS
-                bastion.add_capability(named(), enable_state=True)
-
-                # Turn off cloud-provided resolvconf
-                for host in self.site.host:
-                    host.add_capability(resolvconf())
+            topology_effect(self.site, '_reconcile_site_services')
 
             # 5. If this is an internal interface, enable bird
             if not iface.is_external:
-                self.add_capability(bird(), enable_state=True)
+                topology_effect(self, '_enable_bird')
 
         return self
 
+    def _enable_bird(self):
+        self.add_capability(bird(), enable_state=True)
+
+    def _reconcile_dhclients(self):
+        dhcp_ifaces = self.physical_ifaces.rdf.filter(lambda x: x.routingstyle==RoutingStyle.DHCP)
+        if dhcp_ifaces.size>1 and len(self.fibs)>1:
+
+            # Update previously created dhclient capabilities
+            updated = 0
+            dhclients = self.capability.rdf.filter(lambda x: x.service=='dhclient') if self.capability else []
+            for i, dhclient in enumerate(dhclients):
+                try:
+                    dhclient.db.update({
+                        'start_rc' : False,
+                        'start_local' : True,
+                        'start_local_prms' : dhcp_ifaces[i].name,
+                        'fib' : self.fibs[updated]
+                    })
+                except Exception as e:
+                    print(e)
+                    raise
+                updated += 1
+
+            # Create remaining required dhclients (i.e. for current interface)
+            for i in range(updated, len(self.fibs)):
+                OAG_Capability().db.create({
+                    'deployment' : None,
+                    'host' : self,
+                    'service' : dhc.name,
+                    'stripe' : 0,
+                    'stripe_group' : dhc.name,
+                    'affinity' : None,
+                    'cores' : dhc.cores if dhc.cores else 0,
+                    'memory' : dhc.memory if dhc.memory else 0,
+                    'start_rc' : False,
+                    'start_local' : True,
+                    'start_local_prms' : dhcp_ifaces[i].name,
+                    'fib' : self.fibs[i],
+                    'expose' : False,
+                    'secure' : False,
+                    'custom_pkg' : False,
+                })
+
+    def applied_manifest(self, id_file):
+        """Return the manifest of the configuration this host last applied,
+        or None if it can't be read and a full push is needed"""
+        from frieze.capability.configinit import MANIFEST_FILE
+        output =\
+            subprocess.run(
+                f'ssh root@{self.ip4(fib=FIB.WORLD)} -i {id_file} "cat {MANIFEST_FILE}"',
+                shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+        if output.returncode!=0:
+            return None
+        try:
+            manifest = json.loads(output.stdout.decode())
+        except ValueError:
+            return None
+        if not all([key in manifest for key in ('files', 'knobs', 'apply')]):
+            return None
+        return manifest
+
     @property
     def block_storage(self):
         return OAG_SysMount() if self.site.block_storage.size==0 else self.site.block_storage.clone().rdf.filter(lambda x: x.host.fqdn==self.fqdn)
@@ -1215,7 +1504,8 @@ class OAG_Host(OAG_FriezeRoot):
         }[self.os.family](self)
 
     def configure(self, targetdir):
-        return ConfigInit(self.configprovider.intermediate_representation).generate(targetdir=targetdir)
+        with profiled(rununit=self.fqdn) as p:
+            return p.output(ConfigInit.from_provider(self.configprovider).generate(targetdir=targetdir))
 
     @property
     def containers(self):
@@ -1234,21 +1524,24 @@ class OAG_Host(OAG_FriezeRoot):
     def domain(self):
         return self.site.domain
 
-    @oagprop
-    def fibs(self, **kwargs):
+    @property
+    @frozenprop
+    def fibs(self):
         if self.role==HostRole.SITEBASTION:
             return [FIB.DEFAULT]
         else:
-            return [iface.fib for iface in self.physical_ifaces.clone()]
+            return [iface.fib for iface in self.physical_ifaces]
 
     @property
+    @frozenprop
     def fqdn(self):
         return '%s.%s' % (self.name, self.site.zone)
 
     @property
     def internal_ifaces(self):
-        return self.net_iface.clone().rdf.filter(lambda x: x.is_external is False)
+        return OAGView(self.prefetched('net_iface', copy=False), lambda x: x.is_external is False)
 
+    @frozenprop
     def ip4(self, fib=FIB.DEFAULT):
         """Depending on specified FIB, return relevant IP address. DEFAULT:
         return IP address of internal interface; WORLD means return IP address
@@ -1260,13 +1553,14 @@ class OAG_Host(OAG_FriezeRoot):
 
     @property
     def physical_ifaces(self):
-        return self.net_iface.clone().rdf.filter(lambda x: x.type==NetifType.PHYSICAL)
+        return OAGView(self.prefetched('net_iface', copy=False), lambda x: x.type==NetifType.PHYSICAL)
 
     @property
     def is_bastion(self):
         return self.role==HostRole.SITEBASTION
 
     @property
+    @frozenprop
     def revzone(self):
         return '%s.in-addr.arpa' % '.'.join(reversed(self.ip4().split('.')[:3]))
 
@@ -1276,7 +1570,7 @@ class OAG_Host(OAG_FriezeRoot):
 
     @property
     def routed_subnets(self):
-        return self.subnet.clone()
+        return self.prefetched('subnet')
 
     @property
     def stripe_group(self):
@@ -1329,19 +1623,21 @@ class OAG_NetIface(OAG_FriezeRoot):
             OAError("Non-bridge interfaces can't have bridge members")
 
     @property
+    @frozenprop
     def routed_subnet(self):
         if self.routed_by:
-            return self.routed_by.subnet[-1]
+            return self.routed_by.prefetched('subnet')[-1]
 
         if self.routingstyle==RoutingStyle.STATIC:
             try:
-                return self.subnet[-1]
+                return self.prefetched('subnet')[-1]
             except TypeError:
                 pass
 
         return None
 
     @property
+    @frozenprop
     def broadcast(self):
         if self.is_external:
             if not self.host.c_ip4:
@@ -1353,18 +1649,20 @@ class OAG_NetIface(OAG_FriezeRoot):
             return self.routed_subnet.broadcast if self.routed_subnet else None
 
     @property
+    @frozenprop
     def connected_ifaces(self):
         """Generate IP addressing map on the fly for a given routing interface.
 
         Return the map keyed by inferred name for easy lookup by other interfaces
         trying to learn their IP address. See @property ip4 for example on use."""
-        return {nif.infname:self.routed_subnet[-1].ip4network[i+2] for i, nif in enumerate(self.net_iface_routed_by)}
+        return {nif.infname:self.routed_subnet[-1].ip4network[i+2] for i, nif in enumerate(self.prefetched('net_iface_routed_by'))}
 
     @property
     def dhcpd_enabled(self):
         return self.host.is_bastion and not self.is_external and not self.type==NetifType.VLAN
 
     @property
+    @frozenprop
     def gateway(self):
         if self.is_external:
             return self.host.c_gateway
@@ -1372,6 +1670,7 @@ class OAG_NetIface(OAG_FriezeRoot):
             return self.routed_subnet.gateway if self.routed_subnet else None
 
     @property
+    @frozenprop
     def ip4(self):
 
         rv = None
@@ -1403,6 +1702,7 @@ class OAG_NetIface(OAG_FriezeRoot):
         return ExtCloud(self.host.site.provider).network_iface_mtu(external=self.is_external)
 
     @property
+    @frozenprop
     def netmask(self):
 
         rv = None
@@ -1423,6 +1723,7 @@ class OAG_NetIface(OAG_FriezeRoot):
         return rv
 
     @property
+    @frozenprop
     def routingstyle(self):
         if self.is_external:
             return RoutingStyle.DHCP
@@ -1511,6 +1812,14 @@ class OAG_Site(OAG_FriezeRoot):
             print(f"====> Found previously generated entry for [{host.fqdn}]")
         except OAGraphRetrieveError:
             print(f"====> Creating new entry for [{name}]")
+            host = self._create_host(template, name, role)
+
+        return host
+
+    def _create_host(self, template, name, role):
+        """Create host from template without checking whether it already
+        exists. Callers are responsible for knowing that it doesn't."""
+        with OADbTransaction(f"Create host: {name}"):
             host =\
                 OAG_Host().db.create({
                     'site' : self,
@@ -1523,8 +1832,9 @@ class OAG_Site(OAG_FriezeRoot):
                 })
 
             # Add network interfaces
-            for iface in template.interfaces:
-                host.add_iface(iface[0], iface[1], fib=iface[2] if len(iface)>2 else FIB.DEFAULT)
+            with TopologyBatch():
+                for iface in template.interfaces:
+                    host.add_iface(iface[0], iface[1], fib=iface[2] if len(iface)>2 else FIB.DEFAULT)
 
             # Add tunable parameters
             for sysctl in template.sysctls:
@@ -1572,11 +1882,50 @@ class OAG_Site(OAG_FriezeRoot):
 
         return host
 
+    def _reconcile_site_services(self):
+        if self.bastion:
+            bastion = self.bastion
+
+            # DHCP
+            try:
+                cap_dhcpd = bastion.capability.rdf.filter(lambda x: x.service=='dhcpd') if bastion.capability else bastion.capability
+            except AttributeError:
+                cap_dhcpd = None
+            dhcpd_ifaces = ' '.join([iface.name for iface in bastion.internal_ifaces if iface.dhcpd_enabled])
+            if not cap_dhcpd:
+                dhcpd_capdef = dhcpd().setknob('ifaces', dhcpd_ifaces)
+                bastion.add_capability(dhcpd_capdef, enable_state=True)
+            else:
+                dhcpd_iface_knob = cap_dhcpd.capability_knob.rdf.filter(lambda x: x.knob=='ifaces')
+                if dhcpd_ifaces != dhcpd_iface_knob.value:
+                    dhcpd_iface_knob.db.update({
+                        'value' : dhcpd_ifaces
+                    })
+
+            # DNS
+            bastion.add_capability(named(), enable_state=True)
+
+            # Turn off cloud-provided resolvconf
+            for host in self.host:
+                host.add_capability(resolvconf())
+
+    def _reroute_compute_hosts(self):
+        if self.compute_hosts:
+            for host in self.compute_hosts:
+                for i, int_iface in enumerate(host.internal_ifaces):
+                    try:
+                        int_iface.routed_by = self.bastion.routed_subnets[i].routing_iface
+                        int_iface.fib = FIB.DEFAULT
+                        int_iface.db.update()
+                    except IndexError:
+                        raise OAError("Unable to find corresponding internal routing interface")
+
     @property
+    @frozenprop
     def bastion(self):
-        sitebastions = self.clone()[-1].host.rdf.filter(lambda x: x.is_bastion)
+        sitebastions = OAGView(self.prefetched('host', refresh=True, copy=False), lambda x: x.is_bastion)
         if sitebastions.size==1:
-            return sitebastions
+            return sitebastions.node(0)
         else:
             return None
 
@@ -1600,39 +1949,48 @@ class OAG_Site(OAG_FriezeRoot):
 
     @property
     def compute_hosts(self):
-        compute_hosts = self.host.clone().rdf.filter(lambda x: not x.is_bastion)
-        if compute_hosts.size>0:
-            return compute_hosts
+        # Views carry a cursor, so only the rows are memoized: every caller
+        # gets a view of its own
+        rows = self.compute_host_rows
+        if rows:
+            return OAGView(self.prefetched('host', copy=False), None, rows=rows)
         else:
             return None
 
-    def configure(self):
-
-        # Decide on directory to output files to
-        version_dir = os.path.join(oaenv('frieze').runprops.home, 'domains', self.domain.domain, 'deploy', self.domain.version_name)
-
-        # Create configurations for each host. The configurations contain a
-        # full suite of config files,
-        hostcfgs = {}
-
-        for i, host in enumerate(self.host.db.search()):
+    @property
+    @frozenprop
+    def compute_host_rows(self):
+        """Rows of the site's host collection that aren't bastions"""
+        return OAGView(self.prefetched('host', copy=False), lambda x: not x.is_bastion).matches
 
-            # Fresh start: host config directory
-            host_cfg_dir = os.path.join(version_dir, host.fqdn)
-            try:
-                shutil.rmtree(host_cfg_dir)
-            except FileNotFoundError:
-                pass
+    def configure(self):
+        return dict(self.iter_configs())
 
-            hostcfgs[OAG_Host(host.id)] = host.configure(host_cfg_dir)
+    def iter_configs(self):
+        """Yield (host, configinit tarball) for each host in this site as it
+        is rendered. The configurations contain a full suite of config files,
+        and are kept in the domain's artifact store, where they are
+        materialized under deploy/<version>/<host>."""
+        artifacts = self.domain.artifacts
 
-        return hostcfgs
+        # Each host is yielded as a node of its own, so that callers can hold
+        # on to it while later hosts are rendered
+        hosts = self.prefetched('host', refresh=True)
+        for i in range(hosts.size if hosts else 0):
+            host = hosts.clone()[i]
+            host_tar = host.configure(None)
+            artifacts.add(self.domain.version_name, host.fqdn, host_tar)
+            yield (host, host_tar)
 
     @property
     def containers(self):
         return self.domain.clone()[-1].containers.rdf.filter(lambda x: x.site.id==self.id)
 
     def prepare_infrastructure(self):
+        import gevent
+        import gevent.pool
+
+        from frieze.dbpool import dbupdate, pool_size, pooled_connection
 
         # Prep the external provider
         extcloud = ExtCloud(self.provider)
@@ -1680,13 +2038,14 @@ class OAG_Site(OAG_FriezeRoot):
 
             # Update local IP information for servers that already exist in cloud.
             leave_srv  = self.host.clone().rdf.filter(lambda x: x.fqdn in [v['label'] for v in existing_csrv])
-            for srv in leave_srv:
-                c_srv = [v for v in existing_csrv if v['label']==srv.fqdn][0]
-                srv.db.update({
-                    'c_ip4'     : c_srv['ip4'],
-                    'c_gateway' : c_srv['gateway4'],
-                    'c_netmask' : c_srv['netmask4']
-                })
+            with OADbTransaction("Server enrichment: existing"):
+                for srv in leave_srv:
+                    c_srv = [v for v in existing_csrv if v['label']==srv.fqdn][0]
+                    srv.db.update({
+                        'c_ip4'     : c_srv['ip4'],
+                        'c_gateway' : c_srv['gateway4'],
+                        'c_netmask' : c_srv['netmask4']
+                    })
 
             # Create new servers based on what isn't already present on cloud provider. Spawn
             # greenlets to get the job done faster. extcloud.server_create is guaranteed to
@@ -1697,32 +2056,47 @@ class OAG_Site(OAG_FriezeRoot):
             snapshot = extcloud.snapshot_list()[0]
             sshkey = extcloud.sshkey_list()[0]
 
-            def blocking_server_create(srv):
+            # Each greenlet records what it created on a pooled connection of its
+            # own, so servers are enriched in parallel as they come up. The openarc
+            # connection is shared by every greenlet in the process, so nothing is
+            # written through it from them.
+            glet_pool = gevent.pool.Pool(pool_size())
+
+            def create_server(srv_id, srv):
                 c_srv = extcloud.server_create(srv, networks=networks, sshkey=sshkey, snapshot=snapshot, label=srv.fqdn)
-                srv.db.update({
-                    'c_ip4'     : c_srv['ip4'],
-                    'c_gateway' : c_srv['gateway4'],
-                    'c_netmask' : c_srv['netmask4']
-                })
-                return True
+                with pooled_connection() as dbconn:
+                    dbupdate(dbconn, OAG_Host, srv_id, {
+                        'c_ip4'     : c_srv['ip4'],
+                        'c_gateway' : c_srv['gateway4'],
+                        'c_netmask' : c_srv['netmask4']
+                    })
 
             glets = []
             for i, srv in enumerate(create_srv):
-                glets.append(gevent.spawn(blocking_server_create, srv.clone()[i]))
-            gevent.joinall(glets)
+                srv = srv.clone()[i]
+                glets.append(glet_pool.spawn(create_server, srv.id, srv))
+            gevent.joinall(glets, raise_error=True)
 
             # Update MAC information on network interfaces based on refreshed external cloud list.
+            # Interfaces are looked up here, on the openarc connection; listings are fetched
+            # and written from the greenlets.
             existing_csrv = extcloud.server_list()
-            for host in self.host:
 
-                c_srv = [c_srv for c_srv in existing_csrv if c_srv['label']==host.fqdn][0]
-                c_srv_networks = extcloud.server_private_network_list(c_srv['vsubid'])
+            def enrich_interfaces(vsubid, iface_ids):
+                c_srv_networks = extcloud.server_private_network_list(vsubid)
+                with pooled_connection() as dbconn:
+                    for i, iface_id in enumerate(iface_ids):
+                        if i>0:
+                            dbupdate(dbconn, OAG_NetIface, iface_id, {
+                                'mac' : c_srv_networks[i-1]['mac']
+                            })
 
-                for i, iface in enumerate(host.physical_ifaces):
-                    if i>0:
-                        iface.db.update({
-                            'mac' : c_srv_networks[i-1]['mac']
-                        })
+            glets = []
+            for host in self.host:
+                c_srv = [c_srv for c_srv in existing_csrv if c_srv['label']==host.fqdn][0]
+                iface_ids = [iface.id for iface in host.physical_ifaces]
+                glets.append(glet_pool.spawn(enrich_interfaces, c_srv['vsubid'], iface_ids))
+            gevent.joinall(glets, raise_error=True)
 
         # Attach block storage to relevant servers. block_attach() keeps track
         # of detaching and attaching storage as necessary if our new config has
@@ -1731,19 +2105,24 @@ class OAG_Site(OAG_FriezeRoot):
             for bs in self.block_storage:
                 extcloud.block_attach(bs)
 
+        # Cloud enrichment is the only change made to frozen domains: drop
+        # anything memoized from the previous cloud state.
+        p_frozen_buffer.clear()
+
     @property
     def rununits(self):
         return self.host
 
     @property
+    @frozenprop
     def zone(self):
         return('%s.%s' % (self.shortname, self.domain.domain))
 
     @oagprop
     def expose_map(self, **kwargs):
         expose_map = {}
-        for cap in self.capability_expose:
-            for depl in self.domain.deployment:
+        for cap in self.prefetched('capability_expose'):
+            for depl in self.domain.prefetched('deployment'):
                 for container in depl.containers:
                     if cap.fqdn==container.capability.fqdn:
                         for port in cap.c_capability.ports:
@@ -1889,6 +2268,7 @@ def set_domain(domain,
                cfgfile=None):
 
     ##### Prepare operating environment
+    frieze.init()
 
     # Initialize the domain
     global p_domain
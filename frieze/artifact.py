@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+__all__ = ['ArtifactStore']
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+
+from openarc import oaenv
+from openarc.exception import OAError
+
+class ArtifactStore(object):
+    """Content addressed store for the rendered configurations of a domain,
+    rooted at {root}. Every unique file is kept once under artifacts/objects,
+    named by its sha256. A host's configuration in a version is a manifest of
+    archive member names to hashes, and is materialized in deploy/ as a tree
+    of hardlinks to the objects it names. Writing a version whose files
+    haven't changed only creates links.
+
+    Objects are read-only: a materialized file is the stored object, so
+    editing it in place would change every version sharing it."""
+
+    def __init__(self, root):
+        self.root          = root
+        self.objects_dir   = os.path.join(root, 'artifacts', 'objects')
+        self.manifests_dir = os.path.join(root, 'artifacts', 'manifests')
+        self.deploy_dir    = os.path.join(root, 'deploy')
+
+    def add(self, version, host, tarball, materialize=True):
+        """Store the members of a configinit tarball as host's configuration
+        in version, and optionally materialize it. Returns the manifest."""
+        manifest = {}
+        with tarfile.open(fileobj=io.BytesIO(tarball), mode='r') as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    manifest[member.name] = self.put(tar.extractfile(member).read())
+
+        manifest_file = self.manifest_file(version, host)
+        os.makedirs(os.path.dirname(manifest_file), mode=0o700, exist_ok=True)
+        with open(manifest_file+'.tmp', 'w') as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.rename(manifest_file+'.tmp', manifest_file)
+
+        if materialize:
+            self.materialize(version, host)
+
+        return manifest
+
+    def gc(self, keep=None):
+        """Drop all but the {keep} most recent versions, by default [artifacts]
+        keep_versions from frieze.conf, then delete objects that no remaining
+        manifest refers to. Returns the number of objects deleted."""
+        if keep is None:
+            try:
+                keep = oaenv('frieze').artifacts.keep_versions
+            except (AttributeError, KeyError):
+                keep = 10
+
+        versions = self.versions()
+        for version in versions[:max(len(versions)-keep, 0)]:
+            shutil.rmtree(os.path.join(self.manifests_dir, version))
+            shutil.rmtree(os.path.join(self.deploy_dir, version), ignore_errors=True)
+
+        referenced = set()
+        for version in self.versions():
+            for manifest_file in os.listdir(os.path.join(self.manifests_dir, version)):
+                with open(os.path.join(self.manifests_dir, version, manifest_file), 'r') as f:
+                    referenced.update(json.load(f).values())
+
+        deleted = 0
+        if os.path.exists(self.objects_dir):
+            for prefix in os.listdir(self.objects_dir):
+                for name in os.listdir(os.path.join(self.objects_dir, prefix)):
+                    if prefix+name not in referenced:
+                        os.unlink(os.path.join(self.objects_dir, prefix, name))
+                        deleted += 1
+
+        return deleted
+
+    def get(self, digest):
+        with open(self.object_path(digest), 'rb') as f:
+            return f.read()
+
+    def manifest(self, version, host):
+        try:
+            with open(self.manifest_file(version, host), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise OAError(f"No configuration stored for [{host}] in [{version}]")
+
+    def manifest_file(self, version, host):
+        return os.path.join(self.manifests_dir, version, f'{host}.json')
+
+    def materialize(self, version, host):
+        """(Re)create deploy/{version}/{host} as hardlinks into the store"""
+        targetdir = os.path.join(self.deploy_dir, version, host)
+        try:
+            shutil.rmtree(targetdir)
+        except FileNotFoundError:
+            pass
+        os.makedirs(targetdir, mode=0o700)
+
+        for name, digest in self.manifest(version, host).items():
+            target = os.path.join(targetdir, name)
+            os.makedirs(os.path.dirname(target), mode=0o700, exist_ok=True)
+            try:
+                os.link(self.object_path(digest), target)
+            except OSError:
+                # Store and deploy tree on different filesystems
+                shutil.copyfile(self.object_path(digest), target)
+
+        return targetdir
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def put(self, payload):
+        """Store payload unless it is already present, and return its digest"""
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            with open(path+'.tmp', 'wb') as f:
+                f.write(payload)
+            os.chmod(path+'.tmp', 0o444)
+            os.rename(path+'.tmp', path)
+        return digest
+
+    def versions(self):
+        """Stored versions, oldest first"""
+        if not os.path.exists(self.manifests_dir):
+            return []
+        return sorted(os.listdir(self.manifests_dir), key=lambda v: os.stat(os.path.join(self.manifests_dir, v)).st_mtime_ns)
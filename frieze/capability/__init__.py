@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
 from . import base
+from . import configinit
+from . import profile
+from . import registry
 
 from .base import *
 from .configinit import *
+from .profile import *
+from .registry import *
 
 __all__ = []
 __all__.extend(base.__all__)
 __all__.extend(configinit.__all__)
+__all__.extend(profile.__all__)
+__all__.extend(registry.__all__)
@@ -1,7 +1,6 @@
 __all__ = [
     # Utilities
     'CapabilityTemplate',
-    'add',
     # Base services
     'bird',
     'dhclient',
@@ -22,17 +21,25 @@ __all__ = [
 ]
 
 import frieze
-import importlib
 import io
-import os
-import sys
 import tarfile
 
-import mako.template
-import pkg_resources as pkg
-
 from openarc import staticproperty
 
+from .profile import profiled
+
+# Rendered trust material by sorted alias tuple. Containers serving the same
+# aliases share a certificate, and so the same files. Cleared whenever
+# certificates are (re)issued.
+p_trust_material = {}
+
+def render_template(template, tmplname=None, **kwargs):
+    """Render a mako template. mako is only imported once something is
+    rendered. tmplname identifies the template in render profiles."""
+    import mako.template
+    with profiled(template=tmplname or 'template') as p:
+        return p.output(mako.template.Template(template).render(**kwargs))
+
 class CapabilityTemplate(object):
 
     # Resource expectations.
@@ -66,6 +73,11 @@ class CapabilityTemplate(object):
     # Resource directory (for internal bookkeeping)
     resource_path = 'frieze.capability.resources'
 
+    # How a running host picks up changes to this capability's files: the
+    # service is restarted or reloaded, or nothing is done if the files take
+    # effect by themselves.
+    apply_action = 'restart'
+
     def __init__(self):
         self.set_knobs = {}
         self.cmd_count = 0
@@ -79,6 +91,8 @@ class CapabilityTemplate(object):
         rv = {}
         __exclude__.append('__init__.py')
         __exclude__.append('__pycache__')
+
+        import pkg_resources as pkg
         try:
             cmd_cnt = 0
             cap_cfgs = pkg.resource_listdir(self.resource_path, self.name)
@@ -95,7 +109,7 @@ class CapabilityTemplate(object):
                     cfg_name = bytes(cfg_1l[2:]).decode().split(' ')[0]
 
                 try:
-                    rv[cfg_name] = mako.template.Template(cfg_raw.decode()).render(host=host)
+                    rv[cfg_name] = render_template(cfg_raw.decode(), tmplname=cfg, host=host)
                 except UnicodeDecodeError:
                     rv[cfg_name] = cfg_raw
                 except Exception as e:
@@ -105,6 +119,11 @@ class CapabilityTemplate(object):
             pass
         return rv
 
+    def apply_cmds(self, host, target):
+        """Return the commands that put a change to target, one of the files
+        this capability generates for host, into effect without a reboot"""
+        return [f'service {self.name} {self.apply_action}'] if self.apply_action else []
+
     @staticproperty
     def name(cls):
         return cls.__name__
@@ -132,34 +151,12 @@ class CapabilityTemplate(object):
             OSFamily.FreeBSD: "setfib %s service %s restart %s" % (fib.value, self.name, extra_prms)
         }[os.family]
 
-def add(searchdir):
-    """Add user-defined capabilities in searchdir. Pop up one directory and
-    use import_modules"""
-    canonical_path = os.path.expanduser(searchdir)
-    sys.path.append(canonical_path)
-
-    capmod = importlib.import_module('frieze.capability')
-    modules = os.listdir(canonical_path)
-    for module_name in modules:
-        # Push module information into frieze.capability, and fix resource_path
-        try:
-            module = importlib.import_module(module_name)
-        except ModuleNotFoundError:
-            continue
-
-        for m in dir(module):
-            elem = getattr(module, m)
-            if type(elem)==type and isinstance(elem(), CapabilityTemplate):
-                setattr(capmod, elem.__name__, elem)
-                setattr(elem, 'resource_path', f'{module_name}.resources')
-
-    importlib.invalidate_caches()
-
 ## Service definitions
 
 class bird(CapabilityTemplate):
     package = 'bird'
     jailable = False
+    apply_action = 'reload'
 
 class dhcpd(CapabilityTemplate):
     package = 'isc-dhcp44-server'
@@ -173,6 +170,9 @@ class dhclient(CapabilityTemplate):
 
 class firstboot(CapabilityTemplate):
 
+    # Only used when booting
+    apply_action = None
+
     def generate_cfg_files(self, host, bootstrap=False):
 
         if bootstrap:
@@ -208,10 +208,23 @@ class gateway(CapabilityTemplate): pass
 
 class jail(CapabilityTemplate):
 
+    def __init__(self):
+        super().__init__()
+        # Jail each generated per-jail file belongs to
+        self.jail_files = {}
+
+    def apply_cmds(self, host, target):
+        """Jails pick up their configuration when they start: restart the
+        jail a file belongs to, or all of them if jail.conf changed"""
+        if target in self.jail_files:
+            return [f'service jail restart {self.jail_files[target]}']
+        return ['service jail restart']
+
     def generate_cfg_files(self, host):
         """Generate regular files, and then add in fstabs for individual jails """
         rv = super().generate_cfg_files(host, __exclude__=['jail-fstab', 'jail-zfs-skeleton', 'jail-configinit'])
 
+        import pkg_resources as pkg
         pkg_name = 'frieze.capability.resources.%s' % self.name
         jail_zfs_template    = pkg.resource_string(pkg_name, 'jail-zfs-skeleton').decode()
         jail_fstab_template  = pkg.resource_string(pkg_name, 'jail-fstab').decode()
@@ -219,12 +232,15 @@ class jail(CapabilityTemplate):
 
         for container in host.containers:
             fstab_file = f'/usr/local/jails/{container.sysname}.fstab'
-            rv[self.next_cmd_cfg_name()] = mako.template.Template(jail_zfs_template).render(container=container, host=host)
-            rv[fstab_file] = mako.template.Template(jail_fstab_template).render(container=container, host=host)
+            rv[self.next_cmd_cfg_name()] = render_template(jail_zfs_template, tmplname='jail-zfs-skeleton', container=container, host=host)
+            rv[fstab_file] = render_template(jail_fstab_template, tmplname='jail-fstab', container=container, host=host)
 
             # Create config payload
             cfinit_file = f'{container.jaildir}/root/cfinit'
-            rv[cfinit_file] = mako.template.Template(jail_cfinit_template).render(container=container, host=host)
+            rv[cfinit_file] = render_template(jail_cfinit_template, tmplname='jail-configinit', container=container, host=host)
+
+            self.jail_files[fstab_file] = container.sysname
+            self.jail_files[cfinit_file] = container.sysname
 
         return rv
 
@@ -232,12 +248,14 @@ class linux(CapabilityTemplate): pass
 
 class named(CapabilityTemplate):
     package = 'bind912'
+    apply_action = 'reload'
 
     def generate_cfg_files(self, host):
         rv = {}
         zones = {}
 
         # Load some resources
+        import pkg_resources as pkg
         pkg_name = 'frieze.capability.resources.%s' % self.name
         zone_template        = pkg.resource_string(pkg_name, 'zone.db').decode()
         revzone_template     = pkg.resource_string(pkg_name, 'revzone.db').decode()
@@ -247,13 +265,13 @@ class named(CapabilityTemplate):
         networks = dict()
 
         # Generate forward lookup files
-        for site in host.site.domain.site:
+        for site in host.site.domain.prefetched('site'):
             filename = "/usr/local/etc/namedb/dynamic/%s.db" % site.zone
             zones[site.zone] = filename
-            rv[filename] = mako.template.Template(zone_template).render(zonecontainer=site, host=host)
+            rv[filename] = render_template(zone_template, tmplname='zone.db', zonecontainer=site, host=host)
 
             # Break forward lookups into class C's and assign revzones
-            for dhost in site.host:
+            for dhost in site.prefetched('host'):
                 try:
                     networks[dhost.revzone]
                 except KeyError:
@@ -263,10 +281,10 @@ class named(CapabilityTemplate):
                     'ip_ext' : dhost.ip4().split('.')[-1]
                 })
 
-        for deployment in host.site.domain.deployment:
+        for deployment in host.site.domain.prefetched('deployment'):
             filename = "/usr/local/etc/namedb/dynamic/%s.db" % deployment.zone
             zones[deployment.zone] = filename
-            rv[filename] = mako.template.Template(zone_template).render(zonecontainer=deployment, host=host)
+            rv[filename] = render_template(zone_template, tmplname='zone.db', zonecontainer=deployment, host=host)
 
             for container in deployment.containers:
                 try:
@@ -282,15 +300,16 @@ class named(CapabilityTemplate):
         for nw, zonehosts in networks.items():
             filename = "/usr/local/etc/namedb/dynamic/%s.db" % nw
             zones[nw] = filename
-            rv[filename] = mako.template.Template(revzone_template).render(revzone=nw, zonehosts=zonehosts, host=host)
+            rv[filename] = render_template(revzone_template, tmplname='revzone.db', revzone=nw, zonehosts=zonehosts, host=host)
 
         # Generate named.conf.local
         rv['/usr/local/etc/namedb/named.conf.local'] =\
-            mako.template.Template(named_local_template).render(zones=zones)
+            render_template(named_local_template, tmplname='named.conf.local', zones=zones)
 
         return {**rv, **super().generate_cfg_files(host, __exclude__=['zone.db', 'revzone.db', 'named.conf.local'])}
 
-class pf(CapabilityTemplate): pass
+class pf(CapabilityTemplate):
+    apply_action = 'reload'
 
 class pflate(CapabilityTemplate): pass
 
@@ -299,7 +318,8 @@ class pflog(CapabilityTemplate): pass
 class openssh(CapabilityTemplate):
     package = 'openssh-portable'
 
-class resolvconf(CapabilityTemplate): pass
+class resolvconf(CapabilityTemplate):
+    apply_action = None
 
 class sshd(CapabilityTemplate): pass
 
@@ -309,19 +329,27 @@ class trust(CapabilityTemplate):
         rv = {}
 
         # Generate trusts
-        if type(host)!=frieze.Container:
+        from .._core import nodeclass
+        if nodeclass(host)!=frieze.Container:
             return rv
 
-        from .server import TrustType, CertAction, CertFormat
-
-        pkg_name = 'frieze.capability.resources.%s' % self.name
-        crt_template  = pkg.resource_string(pkg_name, 'chain.crt')
-        priv_template = pkg.resource_string(pkg_name, 'private.pem')
+        from ..certinfo import TrustType, CertAction, CertFormat
 
         cap = host.capability
-        if cap.capability_alias and cap.capability_alias.is_external:
+        capability_alias = cap.prefetched('capability_alias')
+        if capability_alias and capability_alias.is_external:
+            aliases = sorted([ca.fqdn for ca in capability_alias])
+            try:
+                return dict(p_trust_material[tuple(aliases)])
+            except KeyError:
+                pass
+
             print(f'======>Generating trusts for [{cap.fqdn}]')
-            aliases = [ca.fqdn for ca in cap.capability_alias]
+            import pkg_resources as pkg
+            pkg_name = 'frieze.capability.resources.%s' % self.name
+            crt_template  = pkg.resource_string(pkg_name, 'chain.crt')
+            priv_template = pkg.resource_string(pkg_name, 'private.pem')
+
             cert =\
                 cap.deployment.domain\
                 .trust(trust_type=TrustType.LETSENCRYPT)\
@@ -331,17 +359,24 @@ class trust(CapabilityTemplate):
                     cert_format=CertFormat.PEM
                 )
 
-            rv[cap.truststore(pubkey=True)]  = mako.template.Template(crt_template).render(cap=cap, cert=cert)
-            rv[cap.truststore(pubkey=False)] = mako.template.Template(priv_template).render(cap=cap, cert=cert)
+            rv[cap.truststore(pubkey=True)]  = render_template(crt_template, tmplname='chain.crt', cap=cap, cert=cert)
+            rv[cap.truststore(pubkey=False)] = render_template(priv_template, tmplname='private.pem', cap=cap, cert=cert)
+
+            p_trust_material[tuple(aliases)] = dict(rv)
 
         return rv
 
+    @classmethod
+    def clear(cls):
+        p_trust_material.clear()
+
 class zfs(CapabilityTemplate):
 
     def generate_cfg_files(self, host):
 
         rv = super().generate_cfg_files(host, __exclude__=['zpool-init'])
 
+        import pkg_resources as pkg
         pkg_name = 'frieze.capability.resources.%s' % self.name
         zpool_template = pkg.resource_string(pkg_name, 'zpool-init').decode()
 
@@ -351,7 +386,7 @@ class zfs(CapabilityTemplate):
             except KeyError:
                 rv[frieze.capability.ConfigFile.PRE_COMMAND_LIST] = []
             rv[frieze.capability.ConfigFile.PRE_COMMAND_LIST].append(
-                mako.template.Template(zpool_template).render(blockstore=bs, host=host)
+                render_template(zpool_template, tmplname='zpool-init', blockstore=bs, host=host)
             )
 
         return rv
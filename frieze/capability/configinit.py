@@ -4,9 +4,11 @@ __all__ = ['ConfigInit', 'ConfigFile', 'ConfigGenFreeBSD']
 
 import collections
 import enum
-import importlib
+import hashlib
 import io
+import json
 import os
+import shlex
 import tarfile
 
 from openarc.exception import OAError
@@ -14,6 +16,8 @@ from openarc.exception import OAError
 ###### Some other definitions
 from ..osinfo import HostOS, OSFamily, TunableType, Tunable
 from ..hostproperty import HostProperty
+from .profile import profiled
+from .registry import lookup
 
 class ConfigFile(enum.Enum):
     # Commands executed before config payload delivered
@@ -26,15 +30,30 @@ class ConfigFile(enum.Enum):
     # Commands executed after config payload delivered
     POST_COMMAND_LIST = 'post_cmdlist'
 
+# Where configinit leaves the manifest of the files it last wrote
+MANIFEST_FILE = '/var/db/frieze/configinit.manifest'
+
+def member_target(content):
+    """Return the file a configinit member overwrites, or None if it runs a
+    command or appends"""
+    if content[:2]==b'>/':
+        return content[1:content.find(b'\n')].split()[0].decode()
+    return None
+
 class ConfigGenFreeBSD(object):
     def __init__(self, rununit):
         self.rununit = rununit
         self.cfg     = {}
+        # Commands applying a change to a file or rc.conf knob without a
+        # reboot, by file or knob. Anything not in here needs a reboot.
+        self.apply   = {}
+        # Post commands that reboot into the new configuration
+        self.reboot  = []
 
     @property
     def intermediate_representation(self):
         """Generate an intermediate representation that is suitable for output"""
-        from .._core import RoutingStyle, NetifType, FIB, Container, Host
+        from .._core import RoutingStyle, NetifType, FIB, Container, Host, nodeclass
         def gen_sysctl_config(dbsysctl):
             (file, knob, value) = {
                 TunableType.BOOT    : ( ConfigFile.BOOT_LOADER,
@@ -65,15 +84,14 @@ class ConfigGenFreeBSD(object):
                 None : {},
             }[capability.start_rc]
 
-            capmod = importlib.import_module('frieze.capability')
-
             # Generate capability configs
-            service = getattr(capmod, capability.service)()
-            rv = {**rv, **service.generate_cfg_files(self.rununit)}
-
-            # Generate trusts for this host
-            trust = getattr(capmod, 'trust')()
-            rv = {**rv, **trust.generate_cfg_files(self.rununit)}
+            service = lookup(capability.service)()
+            with profiled(capability=service.name) as p:
+                service_cfg = p.output(service.generate_cfg_files(self.rununit))
+                rv = {**rv, **service_cfg}
+            for target in service_cfg:
+                if isinstance(target, str) and target[0]=='/':
+                    self.apply[target] = service.apply_cmds(self.rununit, target)
 
             # Generate auto start/custom start configurations
             if capability.start_rc:
@@ -85,11 +103,22 @@ class ConfigGenFreeBSD(object):
                     value = service.startcmd(self.rununit.os, capability.fib, capability.start_local_prms)
                     rv[ConfigFile.RC_LOCAL][knob] = value
 
-            if capability.capability_knob:
-                for cck in capability.capability_knob:
+            capability_knob = capability.prefetched('capability_knob')
+            if capability_knob:
+                for cck in capability_knob:
                     knob = '%s_%s' % (capability.service, cck.knob)
                     rv[ConfigFile.RC_CONF][knob] = cck.value
 
+            # Services the new configuration enables are restarted. The others
+            # are only stopped, if they run at all: start and stop both fail,
+            # and abort the apply script, when there is nothing to do.
+            if capability.start_rc:
+                apply_cmds = [f'service {service.name} restart']
+            else:
+                apply_cmds = [f'if service {service.name} onestatus >/dev/null 2>&1; then service {service.name} onestop; fi']
+            for knob in rv[ConfigFile.RC_CONF]:
+                self.apply[knob] = apply_cmds
+
             # Force install of custom packages
             if capability.custom_pkg:
                 install_commands = [
@@ -131,7 +160,7 @@ class ConfigGenFreeBSD(object):
                         dct[k] = merge_dct[k]
 
         # Install packages to begin with
-        install_pkgs = [c.package for c in self.rununit.capability if c.package]
+        install_pkgs = [c.package for c in self.rununit.prefetched('capability') if c.package]
         if install_pkgs:
             self.cfg[ConfigFile.PRE_COMMAND_LIST] = []
             self.cfg[ConfigFile.PRE_COMMAND_LIST].append('export ASSUME_ALWAYS_YES=yes && yes | pkg install '+ ' '.join(install_pkgs))
@@ -140,18 +169,25 @@ class ConfigGenFreeBSD(object):
         dict_merge(self.cfg, gen_property_config(HostProperty.hostname, value=self.rununit.fqdn))
 
         # Merge in capability information
-        for capability in self.rununit.capability:
+        for capability in self.rununit.prefetched('capability'):
             dict_merge(self.cfg, gen_capability_config(capability))
 
-        if type(self.rununit)==Host:
+        # Generate trusts for this rununit. They depend on the rununit, not on
+        # each of its capabilities, so are generated once.
+        trust = lookup('trust')()
+        with profiled(capability=trust.name) as p:
+            dict_merge(self.cfg, p.output(trust.generate_cfg_files(self.rununit)))
+
+        if nodeclass(self.rununit)==Host:
 
-            # Tunables
-            for tunable in self.rununit.sysctl:
+            # Tunables. Boot tunables and kernel modules need a reboot.
+            for tunable in self.rununit.prefetched('sysctl'):
                 dict_merge(self.cfg, gen_sysctl_config(tunable))
+            self.apply[ConfigFile.SYSCTL_CONF.value] = [f'sysctl -f {ConfigFile.SYSCTL_CONF.value}']
 
             # Networking
             cloned_ifaces=[]
-            for iface in self.rununit.net_iface:
+            for iface in self.rununit.prefetched('net_iface'):
                 if iface.routingstyle==RoutingStyle.DHCP:
                     value = 'DHCP'
                 elif iface.routingstyle==RoutingStyle.STATIC:
@@ -167,37 +203,136 @@ class ConfigGenFreeBSD(object):
 
             # Finishing commands
             be_name = self.rununit.domain.version_name.lower().replace(' ', '_')
-            self.cfg[ConfigFile.POST_COMMAND_LIST] = [
+            self.reboot = [
                 f'bectl create {be_name}',
                 f'bectl activate {be_name}',
                 f'shutdown -r now'
             ]
-        elif type(self.rununit)==Container:
+            self.cfg[ConfigFile.POST_COMMAND_LIST] = list(self.reboot)
+        elif nodeclass(self.rununit)==Container:
             pass
 
         # Post processing: flatten rc.local into an array of commands to be executed
         try:
             self.cfg[ConfigFile.RC_LOCAL] = [v for k, v in self.cfg[ConfigFile.RC_LOCAL].items()]
+            self.apply[ConfigFile.RC_LOCAL.value] = [f'/bin/sh {ConfigFile.RC_LOCAL.value}']
         except KeyError:
             pass
 
         return self.cfg
 
 class ConfigInit(object):
-    def __init__(self, cfgen):
-        self.cfgen = cfgen
+    def __init__(self, cfgen, apply=None, reboot=None):
+        self.cfgen  = cfgen
+        self.apply  = apply if apply is not None else {}
+        self.reboot = reboot if reboot is not None else []
+
+    @classmethod
+    def from_provider(cls, configprovider):
+        cfgen = configprovider.intermediate_representation
+        return cls(cfgen, apply=configprovider.apply, reboot=configprovider.reboot)
+
+    @staticmethod
+    def delta(tarball, applied, reload=False):
+        """Return the part of a configinit tarball that a target which last
+        applied {applied} (the manifest generate() left on it) still needs:
+        files it already has are left out, and files it has that are no
+        longer part of the configuration are deleted. Commands are always
+        kept.
+
+        If reload is set and every change can be applied live, the reboot is
+        replaced by the commands that apply them: runtime sysctls are loaded,
+        and only services and jails whose files or knobs changed are
+        restarted."""
+        def addfile(tar, name, payload):
+            tarinfo = tarfile.TarInfo(name=name)
+            tarinfo.size = len(payload)
+            tar.addfile(tarinfo=tarinfo, fileobj=io.BytesIO(payload))
+
+        tarout = io.BytesIO()
+        with tarfile.open(fileobj=io.BytesIO(tarball), mode='r') as tarin,\
+             tarfile.open(fileobj=tarout, mode='w') as tar:
+            members = [(member, tarin.extractfile(member).read()) for member in tarin.getmembers() if member.isfile()]
+
+            manifest = None
+            for member, content in members:
+                if member_target(content)==MANIFEST_FILE:
+                    manifest = json.loads(content[content.find(b'\n')+1:].decode())
+                    manifest_arc_file = member.name
+            if manifest is None:
+                return tarball
+
+            files = manifest['files']
+            deleted = sorted(set(applied['files'])-set(files))
+            changed = [target for target in files if applied['files'].get(target)!=files[target]]
+
+            apply_cmds = None
+            if reload:
+                # rc.conf.local is compared knob by knob
+                knobs = sorted([
+                    knob for knob in set(applied['knobs'])|set(manifest['knobs'])
+                    if applied['knobs'].get(knob)!=manifest['knobs'].get(knob)
+                ])
+                apply_cmds = []
+                for key in [t for t in changed+deleted if t!=ConfigFile.RC_CONF.value]+knobs:
+                    cmds = manifest['apply'].get(key, applied['apply'].get(key))
+                    if cmds is None:
+                        apply_cmds = None
+                        break
+                    apply_cmds += [cmd for cmd in cmds if cmd not in apply_cmds]
+
+            for member, content in members:
+                target = member_target(content)
+                if target and target!=MANIFEST_FILE and target not in changed:
+                    continue
+                if apply_cmds is not None and content[:2]==b'#!' and content[3:].decode() in manifest['reboot']:
+                    continue
+
+                if target==MANIFEST_FILE and deleted:
+                    # Deletions go right before the new manifest is recorded
+                    addfile(tar, manifest_arc_file.replace('frieze_manifest', 'frieze_delete'),
+                            ('#!\nrm -f '+' '.join([shlex.quote(path) for path in deleted])).encode())
+                tar.addfile(tarinfo=member, fileobj=io.BytesIO(content))
+                if target==MANIFEST_FILE and apply_cmds:
+                    # ... and changes are applied right after
+                    addfile(tar, manifest_arc_file.replace('frieze_manifest', 'frieze_reload'),
+                            ('#!\n'+'\n'.join(apply_cmds)).encode())
+
+        return tarout.getvalue()
+
+    @staticmethod
+    def reboots(tarball):
+        """True if applying tarball reboots the target"""
+        with tarfile.open(fileobj=io.BytesIO(tarball), mode='r') as tar:
+            members = [tar.extractfile(member).read() for member in tar.getmembers() if member.isfile()]
+        for content in members:
+            if member_target(content)==MANIFEST_FILE:
+                reboot = json.loads(content[content.find(b'\n')+1:].decode())['reboot']
+                return any([content[:2]==b'#!' and content[3:].decode() in reboot for content in members])
+        return False
 
     def generate(self, targetdir=None):
         """Return a configinit compatible representation of a configuration,
         either by parsing {cfgen}, or reading contents of {directory} into a
-        tarball"""
+        tarball. Post commands run last, after a manifest of the files
+        written is recorded on the target for delta()."""
         tarout = io.BytesIO()
         with tarfile.open(fileobj=tarout, mode="w") as tar:
             if self.cfgen:
+                cfgen = [(k, v) for k, v in self.cfgen.items() if k!=ConfigFile.POST_COMMAND_LIST]
+                cfgen.append((MANIFEST_FILE, None))
+                if ConfigFile.POST_COMMAND_LIST in self.cfgen:
+                    cfgen.append((ConfigFile.POST_COMMAND_LIST, self.cfgen[ConfigFile.POST_COMMAND_LIST]))
+
                 # This proceeds in steps:
                 # 1. Normalize cfgen to a dict of filenames, payloads and permissions (omatrix)
                 omatrix = {}
-                for i, (tgt_file, payload) in enumerate(self.cfgen.items()):
+                for i, (tgt_file, payload) in enumerate(cfgen):
+                    if tgt_file==MANIFEST_FILE:
+                        # Filled in once everything else is known
+                        manifest_arc_file = f'{i:05}-frieze_manifest'
+                        omatrix[manifest_arc_file] = None
+                        continue
 
                     # Normalized archive file name
                     src_file = tgt_file.value if isinstance(tgt_file, ConfigFile) else tgt_file
@@ -228,13 +363,32 @@ class ConfigInit(object):
                         # This is a straight config file, just output the payload. Header is assumed
                         omatrix[arc_file] = payload
 
-                # 2. Materialize archive
+                # 2. Record the files written, rc.conf knobs and how to apply
+                #    changes to them, for delta()
+                manifest = {
+                    'files'  : {},
+                    'knobs'  : {k:str(v) for k, v in self.cfgen.get(ConfigFile.RC_CONF, {}).items()},
+                    'apply'  : self.apply,
+                    'reboot' : self.reboot,
+                }
                 for file, content in omatrix.items():
-                    tarinfo = tarfile.TarInfo(name=file)
-                    payload = io.BytesIO()
-                    tarinfo.size = payload.write(content.encode() if type(content)!=bytes else content)
-                    payload.seek(0)
-                    tar.addfile(tarinfo=tarinfo, fileobj=payload)
+                    if content is None:
+                        continue
+                    content = content.encode() if type(content)!=bytes else content
+                    target = member_target(content)
+                    if target:
+                        manifest['files'][target] = hashlib.sha256(content).hexdigest()
+                omatrix[manifest_arc_file] = f'>{MANIFEST_FILE} 0600\n{json.dumps(manifest, sort_keys=True)}'
+
+                # 3. Materialize archive
+                with profiled(template='configinit.tar') as p:
+                    for file, content in omatrix.items():
+                        tarinfo = tarfile.TarInfo(name=file)
+                        payload = io.BytesIO()
+                        tarinfo.size = payload.write(content.encode() if type(content)!=bytes else content)
+                        payload.seek(0)
+                        tar.addfile(tarinfo=tarinfo, fileobj=payload)
+                        p.bytes += tarinfo.size
 
         if targetdir:
             tarout.seek(0)
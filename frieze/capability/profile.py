@@ -0,0 +1,149 @@
+__all__ = [
+    'RenderProfile',
+]
+
+import collections
+import time
+
+# The active RenderProfile, if any
+p_profile = None
+
+class RenderProfile(object):
+    """Opt-in profiler for config generation. While active, every rununit,
+    capability and template rendered records its wall time, the lazy graph
+    loads it triggered (streams that had to be fetched from the database
+    instead of the prefetched version) and the bytes it produced:
+
+        with RenderProfile() as profile:
+            domain.deploy(push=False)
+        print(profile.report(by='template', sort='time'))
+
+    Times are inclusive: a capability's time includes its templates, and a
+    rununit's includes its capabilities and building its tarball."""
+
+    Event = collections.namedtuple('Event', ['rununit', 'capability', 'template', 'time', 'graph_loads', 'bytes'])
+
+    levels = {
+        'rununit'    : lambda e: (e.rununit,),
+        'capability' : lambda e: (e.capability,),
+        'template'   : lambda e: (e.capability, e.template),
+    }
+
+    def __init__(self):
+        self.events      = []
+        self.graph_loads = 0
+        self.stack       = []
+
+    def __enter__(self):
+        global p_profile
+        p_profile = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global p_profile
+        p_profile = None
+
+    def level(self, event):
+        if event.template:
+            return 'template'
+        elif event.capability:
+            return 'capability'
+        else:
+            return 'rununit'
+
+    def measure(self, rununit=None, capability=None, template=None):
+        if self.stack:
+            (outer_rununit, outer_capability) = self.stack[-1]
+            rununit = rununit or outer_rununit
+            capability = capability or outer_capability
+        return Measurement(self, rununit, capability, template)
+
+    def report(self, by='capability', sort='time', limit=None):
+        """Return a table of time, graph loads and bytes aggregated by
+        rununit, capability or template, sorted by time, graph_loads, bytes
+        or calls"""
+        totals = collections.OrderedDict()
+        for event in self.events:
+            if self.level(event)!=by:
+                continue
+            key = self.levels[by](event)
+            total = totals.setdefault(key, {'calls':0, 'time':0.0, 'graph_loads':0, 'bytes':0})
+            total['calls']       += 1
+            total['time']        += event.time
+            total['graph_loads'] += event.graph_loads
+            total['bytes']       += event.bytes
+
+        rows = sorted(totals.items(), key=lambda x: x[1][sort], reverse=True)[:limit]
+
+        formatstr = '%-50s %8s %10s %12s %12s'
+        lines = [formatstr % (by, 'calls', 'time (s)', 'graph loads', 'bytes'), '-'*96]
+        for key, total in rows:
+            lines.append(formatstr % (':'.join([str(k) for k in key]), total['calls'], f"{total['time']:.4f}", total['graph_loads'], total['bytes']))
+        return '\n'.join(lines)
+
+class Measurement(object):
+    def __init__(self, profile, rununit, capability, template):
+        self.profile    = profile
+        self.rununit    = rununit
+        self.capability = capability
+        self.template   = template
+        self.bytes      = 0
+
+    def __enter__(self):
+        self.profile.stack.append((self.rununit, self.capability))
+        self.graph_loads = self.profile.graph_loads
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter()-self.start
+        self.profile.stack.pop()
+        self.profile.events.append(
+            RenderProfile.Event(
+                self.rununit,
+                self.capability,
+                self.template,
+                elapsed,
+                self.profile.graph_loads-self.graph_loads,
+                self.bytes
+            )
+        )
+
+    def output(self, payload):
+        """Attribute payload (a rendered file, a dict of them, or a tarball)
+        to this measurement. Returns payload."""
+        self.bytes += payload_size(payload)
+        return payload
+
+class NullMeasurement(object):
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def output(self, payload):
+        return payload
+
+def graph_load():
+    """Note that a stream was loaded from the database during rendering"""
+    if p_profile:
+        p_profile.graph_loads += 1
+
+def payload_size(payload):
+    if isinstance(payload, dict):
+        return sum([payload_size(v) for v in payload.values()])
+    elif isinstance(payload, (list, tuple)):
+        return sum([payload_size(v) for v in payload])
+    elif isinstance(payload, str):
+        return len(payload.encode())
+    elif isinstance(payload, bytes):
+        return len(payload)
+    else:
+        return 0
+
+def profiled(rununit=None, capability=None, template=None):
+    """Measure the enclosed block if a RenderProfile is active"""
+    return p_profile.measure(rununit, capability, template) if p_profile else NullMeasurement()
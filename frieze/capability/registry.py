@@ -0,0 +1,175 @@
+__all__ = [
+    'add',
+    'lookup',
+]
+
+import ast
+import hashlib
+import importlib
+import json
+import os
+import sys
+
+from . import base
+
+# Capabilities by service name: either the class itself, or a LazyCapability
+# standing in for it until the plugin module is imported.
+p_registry = {
+    name:getattr(base, name) for name in base.__all__
+    if isinstance(getattr(base, name), type) and issubclass(getattr(base, name), base.CapabilityTemplate) and getattr(base, name) is not base.CapabilityTemplate
+}
+
+# Where manifests of plugin directories are cached
+p_manifest_dir = os.path.expanduser('~/.frieze/cache/capabilities')
+
+class LazyCapability(object):
+    """Stand-in for a plugin capability class that hasn't been imported yet.
+    Class attributes recorded in the manifest (package, ports, ...) are
+    answered without importing anything. Calling it, or asking for anything
+    else, imports the plugin and replaces the stand-in with the real class."""
+    def __init__(self, name, module, resource_path, attrs):
+        self.name          = name
+        self.module        = module
+        self.resource_path = resource_path
+        self.attrs         = attrs
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        try:
+            return self.attrs[attr]
+        except KeyError:
+            return getattr(self.load(), attr)
+
+    def load(self):
+        capcls = getattr(importlib.import_module(self.module), self.name)
+        capcls.resource_path = self.resource_path
+        register(capcls)
+        return capcls
+
+def register(capcls):
+    p_registry[capcls.name] = capcls
+    setattr(importlib.import_module('frieze.capability'), capcls.name, capcls)
+
+def lookup(service):
+    """Return the capability class (or its stand-in) for service, or None"""
+    return p_registry.get(service)
+
+def add(searchdir):
+    """Register the capabilities of every plugin package in searchdir. The
+    packages are scanned, not imported: a manifest of the capability classes
+    they define is built from their source and cached until the source
+    changes. Plugins are imported when first instantiated."""
+    canonical_path = os.path.expanduser(searchdir)
+    if canonical_path not in sys.path:
+        sys.path.append(canonical_path)
+
+    manifest = load_manifest(canonical_path)
+    for entry in manifest['capabilities']:
+        if isinstance(p_registry.get(entry['name']), type):
+            # Already imported
+            continue
+        register(LazyCapability(entry['name'], entry['module'], entry['resource_path'], entry['attrs']))
+
+    importlib.invalidate_caches()
+
+def load_manifest(canonical_path):
+    """Return the manifest for canonical_path, rebuilding it if any module in
+    it has changed since it was cached"""
+    sources = {}
+    for package in sorted(os.listdir(canonical_path)):
+        pkgdir = os.path.join(canonical_path, package)
+        if not os.path.exists(os.path.join(pkgdir, '__init__.py')):
+            continue
+        for filename in sorted(os.listdir(pkgdir)):
+            if filename.endswith('.py'):
+                stat = os.stat(os.path.join(pkgdir, filename))
+                sources[os.path.join(package, filename)] = [stat.st_mtime_ns, stat.st_size]
+
+    cache_file = os.path.join(p_manifest_dir, hashlib.sha1(canonical_path.encode()).hexdigest()+'.json')
+    try:
+        with open(cache_file) as f:
+            manifest = json.load(f)
+        if manifest['sources']==sources:
+            return manifest
+    except (IOError, ValueError, KeyError):
+        pass
+
+    manifest = {
+        'sources'      : sources,
+        'capabilities' : scan(canonical_path, sources),
+    }
+    try:
+        os.makedirs(p_manifest_dir, mode=0o700, exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump(manifest, f)
+    except IOError:
+        pass
+
+    return manifest
+
+def literals(capcls):
+    """Return the plain class attributes of an imported capability class"""
+    rv = {}
+    for cls in reversed(capcls.__mro__):
+        for k, v in vars(cls).items():
+            if not k.startswith('_') and isinstance(v, (str, int, float, bool, list, tuple, dict, type(None))):
+                rv[k] = v
+    return rv
+
+def scan(canonical_path, sources):
+    """Find CapabilityTemplate subclasses by parsing plugin sources. Literal
+    class attributes are recorded, including those inherited from other
+    capabilities; anything computed is left out and resolved by importing."""
+    classdefs = {}
+    for source in sources:
+        (package, filename) = os.path.split(source)
+        module = package if filename=='__init__.py' else f'{package}.{filename[:-3]}'
+        with open(os.path.join(canonical_path, source)) as f:
+            tree = ast.parse(f.read(), filename=source)
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef):
+                attrs = {}
+                for stmt in node.body:
+                    if isinstance(stmt, ast.Assign) and len(stmt.targets)==1 and isinstance(stmt.targets[0], ast.Name):
+                        try:
+                            attrs[stmt.targets[0].id] = ast.literal_eval(stmt.value)
+                        except ValueError:
+                            pass
+                bases = [b.id if isinstance(b, ast.Name) else b.attr for b in node.bases if isinstance(b, (ast.Name, ast.Attribute))]
+                classdefs[node.name] = {
+                    'module'        : module,
+                    'resource_path' : f'{package}.resources',
+                    'bases'         : bases,
+                    'attrs'         : attrs,
+                }
+
+    def resolve(name, seen=()):
+        """Return inherited literal attributes of name, or None if name isn't a capability"""
+        if name=='CapabilityTemplate':
+            return literals(base.CapabilityTemplate)
+        if name in p_registry and isinstance(p_registry[name], type):
+            return literals(p_registry[name])
+        if name not in classdefs or name in seen:
+            return None
+        attrs = None
+        for basename in reversed(classdefs[name]['bases']):
+            inherited = resolve(basename, seen+(name,))
+            if inherited is not None:
+                attrs = {**(attrs or {}), **inherited}
+        return None if attrs is None else {**attrs, **classdefs[name]['attrs']}
+
+    capabilities = []
+    for name, classdef in classdefs.items():
+        attrs = resolve(name)
+        if attrs is not None:
+            capabilities.append({
+                'name'          : name,
+                'module'        : classdef['module'],
+                'resource_path' : classdef['resource_path'],
+                'attrs'         : {k:v for k, v in attrs.items() if k!='resource_path'},
+            })
+    return capabilities
@@ -4,21 +4,29 @@ __all__ = [
     'CertAuthInternal',
     'CertAuthLetsEncrypt',
     'CertFormat',
+    'CertStore',
+    'DNSPropagation',
     'ExtDNS'
 ]
 
 import acme.challenges, acme.client, acme.errors, acme.messages, acme.crypto_util
+import atexit
 import base64
+import concurrent.futures
+import contextlib
 import datetime
-import enum
 import hashlib
 import josepy
 import json
 import openarc.exception
 import os
 import pprint
+import queue
 import secrets
+import shutil
+import socket
 import string
+import threading
 import time
 
 from cryptography import x509
@@ -26,7 +34,7 @@ from cryptography.x509.oid import NameOID
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
 
 from bless.config.bless_config import\
     BLESS_OPTIONS_SECTION,\
@@ -46,24 +54,95 @@ from marshmallow.exceptions import ValidationError
 from openarc      import *
 from openarc.time import OATime, coretime
 
+from frieze.certinfo import CertAction, CertFormat, TrustType
 from frieze.provider import ExtCloud
 
-class CertFormat(enum.Enum):
-    SSH = 1
-    PEM = 2
-
-class CertAction(enum.Enum):
-    HOST_ACCESS_USER = 'user host access'
-    HOST_ACCESS_AUTO = 'auto host access'
-    REMOTE_ACCESS    = 'secure remote access'
-    IDENTITY         = 'identity'
+# Issuing an SSH credential used to parse bless.conf and read and decrypt the
+# CA private key every time. Both are kept for the life of the process as
+# {file : (modification time, object)}, so that a regenerated CA replaces the
+# entry of the one it supersedes.
+p_bless_configs = {}
+p_ssh_authorities = {}
+
+# Idle ACME clients by directory url and account key file. A client holds
+# the fetched directory and the nonces handed back by each response, so
+# reusing it saves several round trips per order. Clients aren't thread safe:
+# each is checked out by one worker at a time, see acme_session().
+p_acme_clients = {}
+p_acme_clients_lock = threading.Lock()
+
+# Orders placed and finalized at once by issue_certificates()
+ACME_WORKERS = 8
+
+# Pre-generated subject keys by key type, see SubjectKeyPool
+p_subject_key_pools = {}
+
+def generate_subject_key(keytype):
+    """Return a new private key to be SSH signed. ed25519 keys are
+    effectively free to generate, rsa keys take tens to hundreds of ms."""
+    if keytype=='ed25519':
+        return ed25519.Ed25519PrivateKey.generate()
+    elif keytype=='rsa':
+        return rsa.generate_private_key(
+                   public_exponent=65537,
+                   key_size=2048,
+                   backend=default_backend()
+               )
+    else:
+        raise openarc.exception.OAError(f"Unsupported SSH key type [{keytype}]")
+
+class SubjectKeyPool(object):
+    """Keeps up to {size} subject keys of {keytype} generated ahead of time
+    in a background thread, until stop() is called. A key is never handed out
+    twice; if the pool is drained, keys are generated inline."""
+    def __init__(self, keytype, size):
+        self.keytype = keytype
+        self.keys    = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.thread  = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        key = None
+        while not self.stopped.is_set():
+            if key is None:
+                key = generate_subject_key(self.keytype)
+            try:
+                # Wake up now and then to see if the pool was stopped
+                self.keys.put(key, timeout=1)
+                key = None
+            except queue.Full:
+                pass
 
-    def desc(self, info=None):
-        return f'{self.value}: {info}' if info else f'{self.value}'
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
 
-class TrustType(enum.Enum):
-    INTERNAL    = 'internal'
-    LETSENCRYPT = 'letsencrypt'
+    def get(self):
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            return generate_subject_key(self.keytype)
+
+def subject_key(keytype):
+    """Return a private key to be SSH signed, from the background pool if
+    [ssh] keypool is set in frieze.conf"""
+    try:
+        poolsize = oaenv('frieze').ssh.keypool
+    except (AttributeError, KeyError):
+        poolsize = 0
+    if not poolsize:
+        return generate_subject_key(keytype)
+    if keytype not in p_subject_key_pools:
+        p_subject_key_pools[keytype] = SubjectKeyPool(keytype, poolsize)
+    return p_subject_key_pools[keytype].get()
+
+@atexit.register
+def stop_subject_key_pools():
+    """Stop generating keys in the background, and drop the pools"""
+    while p_subject_key_pools:
+        (keytype, pool) = p_subject_key_pools.popitem()
+        pool.stop()
 
 class Certificate(object):
     def __init__(self, authority, subjects):
@@ -77,6 +156,7 @@ class Certificate(object):
             self.subjects.append(ns_subject)
             self.subjects.sort()
         self.csr = None
+        self.stagedir = None
 
     @property
     def chain(self):
@@ -127,33 +207,81 @@ class Certificate(object):
                 critical=False,
             ).sign(subject_key, hashes.SHA256(), default_backend())
 
-        if not os.path.exists(self.path()):
-            os.makedirs(self.path(), mode=0o700)
-        os.chmod(self.path(), 0o700)
+        # The new key is staged, and only goes live with the chain issued
+        # for it, see install()
+        self.discard()
+        os.makedirs(self.authority.certdir, mode=0o700, exist_ok=True)
+        self.stagedir = f'{self.path()}.{secrets.token_hex(4)}'
+        os.makedirs(self.stagedir, mode=0o700)
 
-        with open(os.open(self.files['private'], os.O_CREAT|os.O_WRONLY, 0o600), 'wb') as f:
+        with open(os.open(os.path.join(self.stagedir, 'private.pem'), os.O_CREAT|os.O_WRONLY|os.O_TRUNC, 0o600), 'wb') as f:
             f.write(subject_key_pem)
+        with open(os.open(os.path.join(self.stagedir, 'subjects.json'), os.O_CREAT|os.O_WRONLY|os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(self.subjects, f)
 
         return (csr.public_bytes(serialization.Encoding.PEM), subjects)
 
+    def discard(self):
+        """Drop the staged key, if any"""
+        if self.stagedir:
+            shutil.rmtree(self.stagedir, ignore_errors=True)
+            self.stagedir = None
+
+    def install(self, fullchain_pem):
+        """Write the chain issued for the staged key next to it, and make
+        both live at once. The certificate's directory is a symlink to its
+        current version, replaced in a single rename, so the key and chain
+        on disk always belong together."""
+        with open(os.open(os.path.join(self.stagedir, 'chain.crt'), os.O_CREAT|os.O_WRONLY|os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(fullchain_pem.encode())
+
+        live = self.path()
+        previous = None
+        if os.path.islink(live):
+            previous = os.path.realpath(live)
+        elif os.path.isdir(live):
+            # Issued before certificates were versioned
+            previous = f'{live}.{secrets.token_hex(4)}'
+            os.rename(live, previous)
+
+        os.symlink(os.path.basename(self.stagedir), f'{self.stagedir}.link')
+        os.replace(f'{self.stagedir}.link', live)
+        self.stagedir = None
+
+        if previous:
+            shutil.rmtree(previous, ignore_errors=True)
+
     @property
     def files(self):
         return {
-            'chain'   : os.path.join(self.path(), 'chain.crt'),
-            'private' : os.path.join(self.path(), 'private.pem'),
+            'chain'    : os.path.join(self.path(), 'chain.crt'),
+            'private'  : os.path.join(self.path(), 'private.pem'),
+            'subjects' : os.path.join(self.path(), 'subjects.json'),
         }
 
     @property
     def inferred_name(self):
         return hashlib.sha256(','.join(self.subjects).encode('utf-8')).hexdigest()
 
+    def expires_within(self, days):
+        """True if the certificate is missing or expires in the next {days} days"""
+        not_valid_after = self.not_valid_after
+        return not_valid_after is None or not_valid_after-datetime.timedelta(days=days)<datetime.datetime.utcnow()
+
     @property
     def is_valid(self):
-        # Do the path validation thing
-        return (
-            os.path.exists(self.files['chain'])
-            and os.path.exists(self.files['private'])
-        )
+        return os.path.exists(self.files['private']) and not self.expires_within(0)
+
+    @property
+    def not_valid_after(self):
+        """Expiry (UTC) of the issued certificate, or None if there isn't one"""
+        chain = self.chain
+        if not chain:
+            return None
+        try:
+            return x509.load_pem_x509_certificate(chain.encode(), default_backend()).not_valid_after
+        except ValueError:
+            return None
 
     def path(self, rootdir=None):
         # The same certificate *may* map to multiple aliases. We need a way to reproducibly
@@ -209,7 +337,7 @@ class CertAuthLetsEncrypt(CertAuthBase):
     def is_valid(self):
         return os.path.exists(self.acme_account_key_file)
 
-    def __challenge_select(self, orderr, type_=acme.challenges.DNS01):
+    def __challenge_select(self, acme_client, orderr, type_=acme.challenges.DNS01):
         """Loop through available challenges and return the one that matches
         type_ in dict (not json) form."""
         cbodies = {}
@@ -219,7 +347,7 @@ class CertAuthLetsEncrypt(CertAuthBase):
             for i in authz.body.challenges:
                 # Find the supported challenge.
                 if isinstance(i.chall, type_):
-                    response, validation = i.chall.response_and_validation(self.acme_client.net.key)
+                    response, validation = i.chall.response_and_validation(acme_client.net.key)
                     cbodies[authz.body.identifier.value] = {
                         'chall'      : i,
                         'response'   : response,
@@ -233,35 +361,76 @@ class CertAuthLetsEncrypt(CertAuthBase):
         if type(subject)!=list:
             subject = [subject]
 
-        cert = Certificate(self, subject)
-        if cert.is_valid:
-            print(f"Valid certificate found for {subject}, not re-issuing")
-        else:
-            random_alt_subject = False
-            try:
-                (csr, csr_subjects) = cert.create_csr()
-                orderr = self.acme_client.new_order(csr)
-            except acme.messages.Error as e:
-                # work around rate limits...
-                print(e)
-                (csr, csr_subjects) = cert.create_csr(random_alt_subject=True)
-                orderr = self.acme_client.new_order(csr)
-
-            cbodies = self.__challenge_select(orderr)
-
-            # Create DNS txt record
-            extcloud = ExtCloud(self.dns_provider)
-            extzone = extcloud.dns_list_zones(name=self.domain.domain)[0]
+        return self.issue_certificates([subject])[0]
+
+    def issue_certificates(self, subject_sets, renew_within=None):
+        """Return a certificate for each list of subjects in subject_sets,
+        issuing the ones that aren't already valid together: orders are
+        placed concurrently, their challenge records are published in a
+        single change per zone, and one propagation wait covers them all.
+        Certificates expiring in the next {renew_within} days are reissued."""
+        certs = [Certificate(self, subjects) for subjects in subject_sets]
+
+        pending = {}
+        for cert in certs:
+            if cert.is_valid and not (renew_within and cert.expires_within(renew_within)):
+                print(f"Valid certificate found for {cert.subjects}, not re-issuing")
+            else:
+                pending[cert.inferred_name] = cert
+        if not pending:
+            return certs
+
+        try:
+            self.__issue_pending(list(pending.values()))
+        finally:
+            # Keys of orders that didn't complete never go live
+            for cert in pending.values():
+                cert.discard()
+
+        # Rendered trust material for these subjects is now stale
+        from ..base import trust
+        trust.clear()
+
+        return certs
+
+    def __issue_pending(self, pending):
+        """Order, validate and install certificates for the list pending"""
+        def place_order(cert):
+            with self.acme_session() as acme_client:
+                try:
+                    (csr, csr_subjects) = cert.create_csr(force=True)
+                    orderr = acme_client.new_order(csr)
+                except acme.messages.Error as e:
+                    # work around rate limits...
+                    print(e)
+                    (csr, csr_subjects) = cert.create_csr(random_alt_subject=True, force=True)
+                    orderr = acme_client.new_order(csr)
+                return (cert, orderr, self.__challenge_select(acme_client, orderr))
+
+        # acme does blocking I/O, so orders are placed and finalized from
+        # threads. Make sure the account exists before they start.
+        with self.acme_session():
+            pass
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(pending), ACME_WORKERS)) as executor:
+            orders = list(executor.map(place_order, pending))
+
+        # Create DNS txt records. A subject may appear in more than one order,
+        # so each record carries every validation asked of it.
+        expected = {}
+        for (cert, orderr, cbodies) in orders:
             for subject, cbody in cbodies.items():
                 print(f"[{subject}] Creating DNS validation TXT [{cbody['validation']}]")
-                zone = extcloud.dns_upsert_record(extzone['vsubid'], f'_acme-challenge.{subject}', cbody['validation'], ttl=5, type_='TXT')
-            del(extcloud)
+                expected.setdefault(f'_acme-challenge.{subject}', []).append(cbody['validation'])
 
-            print(f"Waiting 60 seconds for DNS propagation")
-            time.sleep(60)
+        extcloud = ExtCloud(self.dns_provider)
+        extzone = extcloud.dns_list_zones(name=self.domain.domain)[0]
+        changes = extcloud.dns_upsert_records(extzone['vsubid'], expected, ttl=5, type_='TXT')
+        DNSPropagation(extcloud, extzone).wait(expected, changes=changes)
+        del(extcloud)
 
-            def loop_verification(trycount):
-                acme_client = self.acme_client
+        def finalize_order(order):
+            (cert, orderr, cbodies) = order
+            def loop_verification(trycount, acme_client):
                 print(f'[try {trycount}] Answering challenges')
                 for subject, cbody in cbodies.items():
                     print(f'  Processing: {subject}')
@@ -271,15 +440,16 @@ class CertAuthLetsEncrypt(CertAuthBase):
                 finalized_orderr = acme_client.poll_and_finalize(orderr)
 
                 print(f'Writing out to disk')
-                with open(os.open(cert.files['chain'], os.O_CREAT|os.O_WRONLY, 0o600), 'wb') as f:
-                    f.write(finalized_orderr.fullchain_pem.encode())
+                cert.install(finalized_orderr.fullchain_pem)
 
-            try:
-                loop_verification(1)
-            except acme.errors.TimeoutError:
-                loop_verification(2)
+            with self.acme_session() as acme_client:
+                try:
+                    loop_verification(1, acme_client)
+                except acme.errors.TimeoutError:
+                    loop_verification(2, acme_client)
 
-        return cert
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(orders), ACME_WORKERS)) as executor:
+            list(executor.map(finalize_order, orders))
 
     def _issue_ssh_certificate(self, subject, command, remote_user='root', user_ip=None, validity_length=120, valid_src_ips=None, serialize_to_dir=None):
         raise OAError(f"You can't issue SSH certificates with [{self.trust_type.value} authority")
@@ -340,9 +510,23 @@ class CertAuthLetsEncrypt(CertAuthBase):
         except:
             return None
 
-    @property
-    def acme_client(self):
-        return self.__get_acme_client(self.acme_account_key)
+    @contextlib.contextmanager
+    def acme_session(self):
+        """Check out an idle ACME client for this directory and account, or
+        a new one if they are all in use. The client goes back on the idle
+        list only if the block completes: a client that failed, or was never
+        created, is dropped."""
+        key = (self.acme_url, self.acme_account_key_file)
+        with p_acme_clients_lock:
+            idle = p_acme_clients.setdefault(key, [])
+            acme_client = idle.pop() if idle else None
+        if not acme_client:
+            acme_client = self.__get_acme_client(self.acme_account_key)
+
+        yield acme_client
+
+        with p_acme_clients_lock:
+            p_acme_clients[key].append(acme_client)
 
     @property
     def acme_url(self):
@@ -355,6 +539,46 @@ class CertAuthLetsEncrypt(CertAuthBase):
     def root(self):
         return os.path.join(super().root, oaenv('frieze').acme.env)
 
+class CertStore(object):
+    """Certificates issued by {authority}, indexed by the set of subjects
+    they were issued for"""
+    def __init__(self, authority):
+        self.authority = authority
+
+    def expiring(self, days):
+        return [cert for cert in self.index.values() if cert.expires_within(days)]
+
+    @property
+    def index(self):
+        rv = {}
+        if not os.path.exists(self.authority.certdir):
+            return rv
+        for name in os.listdir(self.authority.certdir):
+            try:
+                with open(os.path.join(self.authority.certdir, name, 'subjects.json'), 'r') as f:
+                    cert = Certificate(self.authority, json.load(f))
+            except (IOError, ValueError):
+                continue
+            if cert.inferred_name==name:
+                rv[frozenset(cert.subjects)] = cert
+        return rv
+
+    def lookup(self, subjects):
+        return self.index.get(frozenset([subject.strip() for subject in subjects]))
+
+    def renew(self, days=None, subject_sets=None):
+        """Reissue certificates that expire in the next {days} days, by
+        default [acme] renew_days from frieze.conf. If subject_sets is given,
+        only those certificates are considered, and missing ones are issued."""
+        if days is None:
+            try:
+                days = oaenv('frieze').acme.renew_days
+            except (AttributeError, KeyError):
+                days = 30
+        if subject_sets is None:
+            subject_sets = [cert.subjects for cert in self.index.values()]
+        return self.authority.issue_certificates(subject_sets, renew_within=days)
+
 class CertAuthInternal(CertAuthBase):
 
     trust_type = TrustType.INTERNAL
@@ -518,18 +742,31 @@ class CertAuthInternal(CertAuthBase):
     def _issue_pem_certificate(self, subject, command, remote_user='root', user_ip=None, validity_length=120, valid_src_ips=None, serialize_to_dir=None):
         raise NotImplementedError("No implementation yet")
 
-    def _issue_ssh_certificate(self, subject, command, remote_user='root', user_ip=None, validity_length=300, valid_src_ips=None, serialize_to_dir=None):
+    @property
+    def bless_config(self):
+        config_file = os.path.join(oaenv('frieze').runprops.home, 'cfg', 'bless.conf')
+        mtime = os.stat(config_file).st_mtime_ns
+        try:
+            (cached_mtime, bless_config) = p_bless_configs[config_file]
+            if cached_mtime==mtime:
+                return bless_config
+        except KeyError:
+            pass
+        p_bless_configs[config_file] = (mtime, BlessConfig(config_file))
+        return p_bless_configs[config_file][1]
+
+    def _issue_ssh_certificate(self, subject, command, remote_user='root', user_ip=None, validity_length=300, valid_src_ips=None, serialize_to_dir=None, keytype=None):
 
         ### Generate new key to be SSH signed
-        subject_private_key =\
-            rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=2048,
-                backend=default_backend()
-            )
+        if not keytype:
+            try:
+                keytype = oaenv('frieze').ssh.keytype
+            except (AttributeError, KeyError):
+                keytype = 'rsa'
+        subject_private_key = subject_key(keytype)
 
         ### Set up bless call
-        config = BlessConfig(os.path.join(oaenv('frieze').runprops.home, 'cfg', 'bless.conf'))
+        config = self.bless_config
         schema = BlessSchema(strict=True)
         schema.context[USERNAME_VALIDATION_OPTION] =\
             config.get(BLESS_OPTIONS_SECTION, USERNAME_VALIDATION_OPTION)
@@ -566,7 +803,7 @@ class CertAuthInternal(CertAuthBase):
         valid_after  = int(OATime(current_time - datetime.timedelta(seconds=validity_length)).to_unixtime())
         valid_before = int(OATime(current_time + datetime.timedelta(seconds=validity_length)).to_unixtime())
 
-        ca = get_ssh_certificate_authority(self.private_key, self.private_key_password)
+        ca = self.ssh_authority
         cert_builder = get_ssh_certificate_builder(ca, SSHCertificateType.USER,
                                                    request.public_key_to_sign)
         for username in request.remote_usernames.split(','):
@@ -603,9 +840,10 @@ class CertAuthInternal(CertAuthBase):
 
         # Return signed credential, or output it to a directory
         serialized_cert    = cert
+        # OpenSSH only reads ed25519 keys in its own format
         serialized_privkey = subject_private_key.private_bytes(
                                  encoding=serialization.Encoding.PEM,
-                                 format=serialization.PrivateFormat.PKCS8,
+                                 format=serialization.PrivateFormat.OpenSSH if keytype=='ed25519' else serialization.PrivateFormat.PKCS8,
                                  encryption_algorithm=serialization.NoEncryption()
                              ).decode()
 
@@ -616,12 +854,12 @@ class CertAuthInternal(CertAuthBase):
                 os.makedirs(serialize_to_dir, mode=0o700)
             os.chmod(serialize_to_dir, 0o700)
 
-            id_name     = 'id_rsa_%s' % self.domain.domain
+            id_name     = 'id_%s_%s' % (keytype, self.domain.domain)
             id_file     = os.path.join(serialize_to_dir, id_name)
             id_file_pub = os.path.join(serialize_to_dir, '%s.pub' % id_name)
-            with open(os.open(id_file, os.O_CREAT|os.O_WRONLY, 0o600), 'w') as f:
+            with open(os.open(id_file, os.O_CREAT|os.O_WRONLY|os.O_TRUNC, 0o600), 'w') as f:
                 f.write(serialized_privkey)
-            with open(os.open(id_file_pub, os.O_CREAT|os.O_WRONLY, 0o600), 'w') as f:
+            with open(os.open(id_file_pub, os.O_CREAT|os.O_WRONLY|os.O_TRUNC, 0o600), 'w') as f:
                 f.write(serialized_cert)
             return (id_file, id_file_pub)
         else:
@@ -638,6 +876,19 @@ class CertAuthInternal(CertAuthBase):
             priv_key = f.read()
         return priv_key
 
+    @property
+    def ssh_authority(self):
+        """The unlocked CA used to sign SSH certificates, loaded once per process"""
+        mtime = os.stat(self.priv_key_file).st_mtime_ns
+        try:
+            (cached_mtime, ssh_authority) = p_ssh_authorities[self.priv_key_file]
+            if cached_mtime==mtime:
+                return ssh_authority
+        except KeyError:
+            pass
+        p_ssh_authorities[self.priv_key_file] = (mtime, get_ssh_certificate_authority(self.private_key, self.private_key_password))
+        return p_ssh_authorities[self.priv_key_file][1]
+
     @property
     def rootca_cert(self):
         if self.is_intermediate_ca:
@@ -669,6 +920,87 @@ class CertAuthInternal(CertAuthBase):
         else:
             return None
 
+class DNSPropagation(object):
+    """Wait for records to become visible on the authoritative nameservers of
+    extzone. The provider is asked first whether the changes have been
+    applied, where it can say; then each nameserver is queried directly, so
+    no resolver caches are involved."""
+
+    def __init__(self, extcloud, extzone, timeout=None, interval=None):
+        self.extcloud = extcloud
+        self.extzone  = extzone
+        try:
+            self.timeout  = timeout if timeout else oaenv('frieze').acme.propagation_timeout
+            self.interval = interval if interval else oaenv('frieze').acme.propagation_interval
+        except (AttributeError, KeyError):
+            self.timeout  = timeout if timeout else 120
+            self.interval = interval if interval else 2
+
+    def nameservers(self):
+        """Addresses of the zone's nameservers, [] if the provider can't
+        list them, or None if they don't resolve (yet)"""
+        try:
+            return [socket.gethostbyname(ns) for ns in self.extcloud.dns_nameservers(self.extzone)]
+        except NotImplementedError:
+            return []
+        except socket.gaierror as e:
+            print(f"Unable to resolve nameservers for [{self.extzone}]: {e}")
+            return None
+
+    def txt_values(self, nameserver, name):
+        """Return the TXT values nameserver has for name"""
+        import dns.exception, dns.resolver
+
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [nameserver]
+        resolver.lifetime = self.interval
+        try:
+            answer = getattr(resolver, 'resolve', resolver.query)(name, 'TXT')
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers, dns.exception.Timeout):
+            return set()
+        return {b''.join(rdata.strings).decode() for rdata in answer}
+
+    def wait(self, expected, changes=None):
+        """Block until every {name : TXT value or [values]} in expected is
+        being served, or the deadline passes. Returns True if propagation was
+        observed."""
+        start = time.monotonic()
+        deadline = start+self.timeout
+
+        def expired():
+            if time.monotonic()<deadline:
+                time.sleep(self.interval)
+                return False
+            print(f"DNS propagation not observed after {self.timeout} seconds, continuing")
+            return True
+
+        pending = [change for change in changes if change] if changes else []
+        while pending:
+            try:
+                pending = [change for change in pending if not self.extcloud.dns_change_insync(change)]
+            except NotImplementedError:
+                pending = []
+            if pending and expired():
+                return False
+
+        nameservers = self.nameservers()
+        while nameservers is None:
+            if expired():
+                return False
+            nameservers = self.nameservers()
+
+        pending = {name:set(values) if type(values)==list else {values} for name, values in expected.items()}
+        while pending and nameservers:
+            pending = {
+                name:values for name, values in pending.items()
+                if not all([values<=self.txt_values(ns, name) for ns in nameservers])
+            }
+            if pending and expired():
+                return False
+
+        print(f"DNS propagation confirmed in {time.monotonic()-start:.1f} seconds")
+        return True
+
 class ExtDNS(object):
 
     def __init__(self, domain):
@@ -695,6 +1027,7 @@ class ExtDNS(object):
 
         # Get list of records already there, update or create them as necessary
         ext_aliases = {r['name']:r for r in extcloud.dns_list_records(extzone, types=['A'])}
+        records = {}
         for alias, expected_ip in needed.items():
             if alias in ext_aliases and expected_ip==ext_aliases[alias]['value']:
                 print(f"No update required for alias [{alias}], it is already set to [{expected_ip}]")
@@ -704,4 +1037,7 @@ class ExtDNS(object):
             except KeyError:
                 print(f"Creating new record for alias [{alias}]: {expected_ip}")
 
-            extcloud.dns_upsert_record(extzone['vsubid'], alias, expected_ip)
+            records[alias] = expected_ip
+
+        if records:
+            extcloud.dns_wait_insync(extcloud.dns_upsert_records(extzone['vsubid'], records))
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+__all__ = ['CertAction', 'CertFormat', 'TrustType']
+
+import enum
+
+# Kept apart from frieze.capability.server so that naming a trust or
+# certificate type doesn't pull in acme, bless and cryptography.
+
+class CertFormat(enum.Enum):
+    SSH = 1
+    PEM = 2
+
+class CertAction(enum.Enum):
+    HOST_ACCESS_USER = 'user host access'
+    HOST_ACCESS_AUTO = 'auto host access'
+    REMOTE_ACCESS    = 'secure remote access'
+    IDENTITY         = 'identity'
+
+    def desc(self, info=None):
+        return f'{self.value}: {info}' if info else f'{self.value}'
+
+class TrustType(enum.Enum):
+    INTERNAL    = 'internal'
+    LETSENCRYPT = 'letsencrypt'
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+__all__ = ['EmbeddedCluster']
+
+import os
+import shutil
+import subprocess
+
+from openarc.exception import OAError
+
+class EmbeddedCluster(object):
+    """Private Postgres cluster living in {datadir}, reachable only through a
+    unix socket in the same directory. Use it for local modelling, test and
+    benchmark runs that shouldn't depend on a shared database server.
+
+    This is still postgres, since openarc only speaks postgres, but it costs
+    nothing to reach once it is up. The cluster is left running when frieze
+    exits, so only the first run pays for initdb and startup: later runs only
+    check the postmaster pid and that the database exists, without spawning
+    anything. Unless {durable} is set, fsync and synchronous commits are
+    turned off: the cluster trades crash safety for speed, and should hold
+    nothing that can't be rebuilt. Put {datadir} on a memory filesystem to
+    keep it off disk entirely."""
+
+    def __init__(self, datadir, dbname='frieze', user='frieze', port=5432, durable=False, bindir=None):
+        self.datadir = datadir
+        self.dbname  = dbname
+        self.user    = user
+        self.port    = port
+        self.durable = durable
+        self.bindir  = bindir
+
+    def binary(self, name):
+        path = os.path.join(self.bindir, name) if self.bindir else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise OAError(f"Unable to find [{name}]: install postgres or set [storage] bindir in frieze.conf")
+        return path
+
+    @property
+    def dbinfo(self):
+        """Connection parameters for openarc"""
+        return {
+            'host'     : self.datadir,
+            'port'     : self.port,
+            'user'     : self.user,
+            'password' : str(),
+            'dbname'   : self.dbname,
+        }
+
+    @property
+    def is_initialized(self):
+        return os.path.exists(os.path.join(self.datadir, 'PG_VERSION'))
+
+    @property
+    def is_running(self):
+        """Whether the postmaster in postmaster.pid is alive and listening.
+        Cheaper than pg_ctl status, which is a process of its own."""
+        try:
+            with open(os.path.join(self.datadir, 'postmaster.pid')) as f:
+                pid = int(f.readline())
+            os.kill(pid, 0)
+        except (OSError, ValueError):
+            return False
+        return os.path.exists(os.path.join(self.datadir, f'.s.PGSQL.{self.port}'))
+
+    def create_database(self):
+        """Create the database, unless it exists already. Checked on every
+        start, since the cluster can outlive its database."""
+        import psycopg2
+
+        dbconn = psycopg2.connect(**{**self.dbinfo, 'dbname' : 'postgres'})
+        try:
+            dbconn.autocommit = True
+            with dbconn.cursor() as cur:
+                cur.execute(SQL.database_exists, [self.dbname])
+                if cur.fetchone() is None:
+                    print(f"====> Creating embedded database [{self.dbname}]")
+                    cur.execute(SQL.create_database % psycopg2.extensions.quote_ident(self.dbname, cur))
+        finally:
+            dbconn.close()
+
+    def initialize(self):
+        print(f"====> Initializing embedded database in [{self.datadir}]")
+        subprocess.run([self.binary('initdb'), '-D', self.datadir, '-U', self.user, '--auth=trust', '-E', 'UTF8'],
+                       stdout=subprocess.DEVNULL, check=True)
+
+    def start(self):
+        if not self.is_initialized:
+            self.initialize()
+
+        if not self.is_running:
+            options = [
+                "-c listen_addresses=''",
+                f"-c unix_socket_directories='{self.datadir}'",
+                f"-c port={self.port}",
+            ]
+            if not self.durable:
+                options += [
+                    "-c fsync=off",
+                    "-c synchronous_commit=off",
+                    "-c full_page_writes=off",
+                ]
+            subprocess.run([self.binary('pg_ctl'), 'start', '-w', '-s',
+                            '-D', self.datadir,
+                            '-l', os.path.join(self.datadir, 'postgres.log'),
+                            '-o', ' '.join(options)],
+                           check=True)
+
+        self.create_database()
+
+        return self
+
+    def stop(self):
+        if self.is_running:
+            subprocess.run([self.binary('pg_ctl'), 'stop', '-w', '-s', '-m', 'fast', '-D', self.datadir], check=True)
+        return self
+
+class SQL(object):
+    database_exists =\
+        "SELECT 1 FROM pg_database WHERE datname=%s"
+    create_database =\
+        "CREATE DATABASE %s"
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+__all__ = ['dbinsert', 'dbupdate', 'dbupdate_keys', 'pool_size', 'pooled_connection']
+
+import contextlib
+import openarc
+import threading
+
+# Connections handed out by pooled_connection(), created on first use
+p_pool = None
+p_pool_lock = threading.Lock()
+
+def wait(dbconn):
+    """Park the calling greenlet, instead of the whole thread, until the
+    asynchronous dbconn is done with its current operation"""
+    import psycopg2
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = dbconn.poll()
+        if state==psycopg2.extensions.POLL_OK:
+            break
+        elif state==psycopg2.extensions.POLL_READ:
+            wait_read(dbconn.fileno())
+        elif state==psycopg2.extensions.POLL_WRITE:
+            wait_write(dbconn.fileno())
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state}")
+
+def execute(dbconn, sql, params=None):
+    with dbconn.cursor() as cur:
+        cur.execute(sql, params)
+        wait(dbconn)
+
+def pool_size():
+    try:
+        return openarc.oaenv('frieze').dbpool.size
+    except (AttributeError, KeyError):
+        return 8
+
+def get_pool():
+    global p_pool
+
+    with p_pool_lock:
+        if p_pool is None:
+            import psycopg2.pool
+
+            # Pooled connections are asynchronous, so that greenlets holding
+            # different connections run their queries concurrently. openarc's
+            # own connection is left alone.
+            p_pool =\
+                psycopg2.pool.ThreadedConnectionPool(
+                    0, pool_size(),
+                    async_=True,
+                    **{k:v for k, v in openarc.oaenv.dbinfo.items() if k!='on_demand_schema'}
+                )
+        return p_pool
+
+@contextlib.contextmanager
+def pooled_connection():
+    """Check a connection out of the pool for the calling greenlet or thread.
+    Everything executed on it is one transaction, committed when the block
+    exits and rolled back if it raises. Callers must bound their concurrency
+    to [dbpool] size: the pool doesn't block when it runs out."""
+    pool = get_pool()
+    dbconn = pool.getconn()
+    try:
+        wait(dbconn)
+        execute(dbconn, SQL.begin)
+        yield dbconn
+        execute(dbconn, SQL.commit)
+    except:
+        if not dbconn.closed:
+            execute(dbconn, SQL.rollback)
+        raise
+    finally:
+        pool.putconn(dbconn)
+
+def dbupdate(dbconn, oagcls, id_, values):
+    """Write {field : value} to the row id_ of oagcls on dbconn, bypassing
+    openarc. Nodes already loaded don't see the change until reloaded."""
+    node = oagcls()
+    columns = node.stream_db_mapping
+    assignments = ', '.join([f'{columns[field]}=%s' for field in values])
+    execute(dbconn, SQL.update_by_id % (oagcls.context, node.dbtable, assignments, node.dbpkname), (*values.values(), id_))
+
+def dbinsert(dbconn, oagcls, rows, batch_rows=500):
+    """Insert rows, a list of {field : value}, into oagcls on dbconn with one
+    statement per batch_rows rows, bypassing openarc. Fields left out of a
+    row are NULL. Returns the ids of the new rows, in order."""
+    node = oagcls()
+    columns = node.stream_db_mapping
+    fields = list(oagcls.streams)
+    row_sql = '(%s)' % ', '.join(['%s']*len(fields))
+
+    ids = []
+    with dbconn.cursor() as cur:
+        for i in range(0, len(rows), batch_rows):
+            values = ', '.join([cur.mogrify(row_sql, [row.get(field) for field in fields]).decode() for row in rows[i:i+batch_rows]])
+            cur.execute(SQL.insert % (oagcls.context, node.dbtable, ', '.join([columns[field] for field in fields]), values, node.dbpkname))
+            wait(dbconn)
+            ids.extend([id_ for (id_,) in cur.fetchall()])
+    return ids
+
+def dbupdate_keys(dbconn, oagcls, fields, rows, batch_rows=500):
+    """Set the forward keys fields of existing rows of oagcls on dbconn, one
+    statement per batch_rows rows. rows is a list of (id, {field : id})."""
+    node = oagcls()
+    columns = node.stream_db_mapping
+    row_sql = '(%s)' % ', '.join(['%s']*(len(fields)+1))
+    assignments = ', '.join([f'{columns[field]}=v.{field}::integer' for field in fields])
+
+    with dbconn.cursor() as cur:
+        for i in range(0, len(rows), batch_rows):
+            values = ', '.join([cur.mogrify(row_sql, [id_]+[keys.get(field) for field in fields]).decode() for (id_, keys) in rows[i:i+batch_rows]])
+            cur.execute(SQL.update_keys % (oagcls.context, node.dbtable, assignments, values, ', '.join(['id']+fields), node.dbpkname))
+            wait(dbconn)
+
+class SQL(object):
+    begin =\
+        "BEGIN"
+    commit =\
+        "COMMIT"
+    rollback =\
+        "ROLLBACK"
+    insert =\
+        "INSERT INTO %s.%s (%s) VALUES %s RETURNING %s"
+    update_by_id =\
+        "UPDATE %s.%s SET %s WHERE %s=%%s"
+    update_keys =\
+        "UPDATE %s.%s AS t SET %s FROM (VALUES %s) AS v(%s) WHERE t.%s=v.id::integer"
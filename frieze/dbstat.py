@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+__all__ = ['SeqScanMonitor']
+
+import openarc
+import time
+
+from openarc import oalog
+
+class SeqScanMonitor(object):
+    """Context manager that warns about frieze tables which were read with
+    sequential scans while it was active. Wrap hot paths (placement, config
+    generation) in it to find lookups that aren't served by any dbindices.
+
+    Postgres publishes table statistics asynchronously, so the monitor waits
+    {settle} seconds before taking its closing reading."""
+
+    def __init__(self, schema='frieze', min_tuples=1000, settle=1.0, enabled=True):
+        self.schema     = schema
+        self.min_tuples = min_tuples
+        self.settle     = settle
+        self.enabled    = enabled
+        self.before     = {}
+        self.after      = {}
+
+    def __enter__(self):
+        if self.enabled:
+            self.before = self.snapshot()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.enabled and not exc_type:
+            time.sleep(self.settle)
+            self.after = self.snapshot()
+            for table, (seq_scan, seq_tup_read, idx_scan) in self.report().items():
+                oalog.warning(f"[{self.schema}.{table}] {seq_scan} sequential scans ({seq_tup_read} rows read) vs {idx_scan} index scans")
+
+    def report(self):
+        """Return {table : (seq scans, rows read by seq scans, idx scans)} for
+        tables whose sequential scans read at least min_tuples rows"""
+        rv = {}
+        for table, (seq_scan, seq_tup_read, idx_scan) in self.after.items():
+            (b_seq_scan, b_seq_tup_read, b_idx_scan) = self.before.get(table, (0, 0, 0))
+            delta = (seq_scan-b_seq_scan, seq_tup_read-b_seq_tup_read, idx_scan-b_idx_scan)
+            if delta[0]>0 and delta[1]>=self.min_tuples:
+                rv[table] = delta
+        return rv
+
+    def snapshot(self):
+        import psycopg2
+
+        dbconn = psycopg2.connect(**{k:v for k, v in openarc.oaenv.dbinfo.items() if k!='on_demand_schema'})
+        try:
+            with dbconn.cursor() as cur:
+                cur.execute(self.SQL.clear_snapshot)
+                cur.execute(self.SQL.table_scans, (self.schema,))
+                return {relname:(seq_scan, seq_tup_read, idx_scan or 0) for (relname, seq_scan, seq_tup_read, idx_scan) in cur.fetchall()}
+        finally:
+            dbconn.close()
+
+    class SQL(object):
+        clear_snapshot =\
+            "SELECT pg_stat_clear_snapshot()"
+        table_scans =\
+            "SELECT relname, seq_scan, seq_tup_read, idx_scan FROM pg_stat_user_tables WHERE schemaname=%s"
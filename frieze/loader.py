@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+
+__all__ = ['load_domain']
+
+import base64
+import collections
+import enum
+import os
+import toml
+
+import frieze
+import frieze.capability
+
+from openarc import OAG_RootNode
+from openarc.exception import OAError
+
+from frieze._core import\
+    FIB, HostRole, NetifType, RoutingStyle, SubnetType, TopologyBatch,\
+    OAG_Capability, OAG_CapabilityAlias, OAG_CapabilityKnob,\
+    OAG_CapabilityRequiredMount, OAG_CapabilityRole, OAG_Deployment,\
+    OAG_Host, OAG_NetIface, OAG_Role, OAG_Site, OAG_Subnet, OAG_Sysctl,\
+    allocate_subnet
+from frieze.capability import\
+    dhclient as dhc, bird, dhcpd, firstboot, gateway, jail, named, pf,\
+    pflate, pflog, resolvconf, zfs
+from frieze.dbpool import dbinsert, dbupdate_keys, pooled_connection
+from frieze.hosttype import HostTemplate
+from frieze.osinfo import HostOS, Tunable, TunableType
+from frieze.provider import CloudProvider, Location
+
+# Rows per INSERT statement when loading a topology
+LOADER_BATCH_ROWS = 500
+
+def load_domain(topology):
+    """Build a domain from a declarative topology description, given either as
+    a path to a TOML file or as an already parsed dict:
+
+        [domain]
+        domain = "openrelay.io"
+        org    = "OpenRelay"
+
+        [templates.SmallCompute]
+        cores     = 1
+        memory    = 1024
+        bandwidth = 1024
+        os        = "FreeBSD_12_0"
+
+        [[roles]]
+        username = "openrelay_rw"
+
+        [[sites]]
+        name      = "Vultr NY1"
+        shortname = "ny1"
+        provider  = "VULTR"
+        location  = "NY"
+
+          [[sites.hosts]]
+          template = "SmallCompute"
+          role     = "SITEBASTION"
+          names    = ["installation01"]
+
+        [[deployments]]
+        name     = "app"
+        affinity = "Vultr NY1"
+
+          [[deployments.capabilities]]
+          capability  = "openrelaydb"
+          max_stripes = 1
+          knobs       = { appname = "openrelay" }
+          acls        = [["openrelay_rw", "RW"]]
+
+    Templates fall back to HostTemplate for anything they don't set. Template
+    interfaces, sysctls and caps are given as lists of the same tuples used in
+    HostTemplate, with enums named by member. Sites and deployments are
+    referred to by name, capabilities by their name in frieze.capability.
+
+    The topology is planned in memory by TopologyPlan, with the same rules the
+    add_* methods apply one row at a time, and then inserted in batches in a
+    single transaction. Only domains without sites, deployments or roles can
+    be loaded: extend existing ones with the add_* methods."""
+
+    if not isinstance(topology, dict):
+        with open(topology) as f:
+            topology = toml.loads(f.read())
+
+    templates = {name:_template(name, spec) for name, spec in topology.get('templates', {}).items()}
+
+    domain = frieze.set_domain(**topology['domain'])
+    if domain.is_frozen:
+        raise OAError("This domain is currently frozen. Consider cloning and re-issuing your request")
+
+    domain.db.search()
+    if domain.site or domain.deployment or domain.role:
+        raise OAError(f"[{domain.domain}] already has a topology. Extend it with the add_* methods instead")
+
+    plan = TopologyPlan(domain)
+
+    for role in topology.get('roles', []):
+        plan.add_role(**role)
+
+    sites = {}
+    for sitespec in topology.get('sites', []):
+        site = plan.add_site(
+            sitespec['name'],
+            sitespec['shortname'],
+            CloudProvider[sitespec['provider']],
+            Location[sitespec['location']],
+        )
+        sites[sitespec['name']] = site
+
+        hosts = sitespec.get('hosts', [])
+        print(f"====> Planning {sum([len(h['names']) for h in hosts])} hosts in site [{sitespec['name']}]")
+
+        # Bastions go first: compute host interfaces are routed by them
+        for hostspec in sorted(hosts, key=lambda x: x['role']!='SITEBASTION'):
+            template = templates[hostspec['template']]
+            role = frieze.HostRole[hostspec['role']]
+            for name in hostspec['names']:
+                plan.add_host(site, template, name, role)
+
+    deployments = []
+    for deplspec in topology.get('deployments', []):
+        print(f"====> Planning deployment [{deplspec['name']}]")
+        deployments.append((plan.add_deployment(deplspec['name']), deplspec))
+
+    # Capabilities are added after topology effects are applied so that they
+    # see the final state of every host
+    plan.apply_effects()
+
+    for depl, deplspec in deployments:
+        for capspec in deplspec.get('capabilities', []):
+            capspec = dict(capspec)
+            capdef = getattr(frieze.capability, capspec.pop('capability'))()
+            for knob, value in capspec.pop('knobs', {}).items():
+                capdef.setknob(knob, value)
+            if 'affinity' in capspec:
+                capspec['affinity'] = sites[capspec['affinity']]
+            if 'expose' in capspec:
+                capspec['expose'] = sites[capspec['expose']]
+            capspec['acls'] = [(username, frieze.RoleACL[acl]) for (username, acl) in capspec.get('acls', [])]
+            plan.add_deployment_capability(depl, capdef, **capspec)
+
+    print(f"====> Inserting {plan.size} rows into [{domain.domain}]")
+    plan.insert()
+    domain.db.search()
+
+    return domain
+
+class PlannedRow(object):
+    """Row of oagcls planned by TopologyPlan. Forward keys hold other planned
+    rows, or existing nodes, until the plan is inserted and every planned row
+    is given its id."""
+    def __init__(self, oagcls, values):
+        self.oagcls = oagcls
+        self.values = values
+        self.id     = None
+
+    def __getitem__(self, field):
+        return self.values.get(field)
+
+    def __setitem__(self, field, value):
+        self.values[field] = value
+
+class TopologyPlan(object):
+    """Rows of a topology, computed in memory. Each add_* method mirrors the
+    method of the same name on the graph nodes, and topology effects are
+    recorded and applied in the same order TopologyBatch runs them, so that
+    the inserted rows are the ones the add_* methods would have created."""
+
+    # Tables are inserted in this order, so that forward keys only point back.
+    # References within a table are set once all of its rows exist.
+    tables = [
+        OAG_Role,
+        OAG_Site,
+        OAG_Deployment,
+        OAG_Host,
+        OAG_NetIface,
+        OAG_Subnet,
+        OAG_Sysctl,
+        OAG_Capability,
+        OAG_CapabilityKnob,
+        OAG_CapabilityAlias,
+        OAG_CapabilityRole,
+        OAG_CapabilityRequiredMount,
+    ]
+
+    def __init__(self, domain):
+        self.domain  = domain
+        self.rows    = {oagcls:[] for oagcls in self.tables}
+        self.pending = collections.OrderedDict()
+
+        # Subnets the domain already has take part in allocation
+        self.existing_subnets = []
+        if domain.subnet:
+            self.existing_subnets = [(esub.type, esub.ip4network) for esub in domain.subnet]
+
+    @property
+    def size(self):
+        return sum([len(rows) for rows in self.rows.values()])
+
+    def add(self, oagcls, **values):
+        row = PlannedRow(oagcls, values)
+        self.rows[oagcls].append(row)
+        return row
+
+    def select(self, oagcls, **values):
+        """Planned rows of oagcls matching values, in insert order"""
+        return [row for row in self.rows[oagcls] if all([row[field]==value for field, value in values.items()])]
+
+    ## Graph properties, evaluated against planned rows
+
+    def bastion(self, site):
+        sitebastions = [host for host in self.select(OAG_Host, site=site) if self.is_bastion(host)]
+        return sitebastions[0] if len(sitebastions)==1 else None
+
+    def fibs(self, host):
+        if self.is_bastion(host):
+            return [FIB.DEFAULT]
+        else:
+            return [iface['fib'] for iface in self.physical_ifaces(host)]
+
+    def internal_ifaces(self, host):
+        return [iface for iface in self.select(OAG_NetIface, host=host) if iface['is_external'] is False]
+
+    def is_bastion(self, host):
+        return host['role']==HostRole.SITEBASTION
+
+    def physical_ifaces(self, host):
+        return [iface for iface in self.select(OAG_NetIface, host=host) if iface['type']==NetifType.PHYSICAL]
+
+    def routed_subnets(self, host):
+        return self.select(OAG_Subnet, router=host)
+
+    def routingstyle(self, iface):
+        if iface['is_external']:
+            return RoutingStyle.DHCP
+        elif self.bastion(iface['host']['site']):
+            if self.is_bastion(iface['host']):
+                return RoutingStyle.STATIC
+            elif iface['type']==NetifType.PHYSICAL:
+                return RoutingStyle.DHCP
+            else:
+                return RoutingStyle.STATIC
+        else:
+            return RoutingStyle.UNROUTED
+
+    def dhcpd_enabled(self, iface):
+        return self.is_bastion(iface['host']) and not iface['is_external'] and not iface['type']==NetifType.VLAN
+
+    ## Rows
+
+    def add_role(self, username, password=None, ssl_enabled=False):
+        if not password:
+            password=base64.b16encode(os.urandom(16)).decode('ascii')
+        return self.add(OAG_Role, domain=self.domain, username=username, password=password)
+
+    def add_site(self, sitename, shortname, provider, location):
+        return self.add(OAG_Site, domain=self.domain, name=sitename, shortname=shortname, provider=provider, location=location)
+
+    def add_deployment(self, name):
+        depl = self.add(OAG_Deployment, domain=self.domain, seqnum=len(self.rows[OAG_Deployment]), name=name)
+
+        for site in self.rows[OAG_Site]:
+            for host in self.select(OAG_Host, site=site):
+                try:
+                    hostiface = self.internal_ifaces(host)[0]
+                except IndexError:
+                    raise OAError(f"[{host['name']}] has no internal interface to put VLAN [{depl['seqnum']}] on")
+                self.add_iface(host, 'vlan%d' % depl['seqnum'], False, hostiface=hostiface, type_=NetifType.VLAN, deployment=depl)
+
+        return depl
+
+    def add_host(self, site, template, name, role):
+        host =\
+            self.add(OAG_Host,
+                site=site,
+                cores=template.cores,
+                memory=template.memory,
+                bandwidth=template.bandwidth,
+                name=name,
+                role=role,
+                os=template.os
+            )
+
+        # Add network interfaces
+        for iface in template.interfaces:
+            self.add_iface(host, iface[0], iface[1], fib=iface[2] if len(iface)>2 else FIB.DEFAULT)
+
+        # Add tunable parameters
+        for sysctl in template.sysctls:
+            if sysctl[0].family == host['os'].family:
+                self.add(OAG_Sysctl, host=host, tunable=sysctl[0], type=sysctl[1], value=sysctl[2])
+            else:
+                print("[%s] tunable not compatible with [%s]" % (sysctl[0], host['os']))
+
+        # Turn on forwarding and pf by default: EVERY host is a router
+        self.add_capability(host, firstboot())
+        self.add_capability(host, gateway(), enable_state=True)
+        self.add_capability(host, pf(), enable_state=True)
+        self.add_capability(host, pflog(), enable_state=True)
+        if role==HostRole.SITEBASTION:
+            self.add_capability(host, pflate(), enable_state=True)
+        self.add_capability(host, zfs(), enable_state=True)
+        if role==HostRole.COMPUTE:
+            self.add_capability(host, jail(), enable_state=True)
+
+        # On host (i.e. bare metal, non-jailed) processes
+        for cap in template.caps:
+            try:
+                (capability, enabled, externally_accessible) = cap
+
+                # Determine FIB information, set enable status accordingly
+                fibs = [FIB.WORLD] if (externally_accessible and len(self.fibs(host))>1) else self.fibs(host)
+                enable_state = False if len(fibs)>1 else enabled
+                for fib in fibs:
+                    self.add_capability(host, capability(), enable_state=enable_state, fib=fib)
+            except ValueError:
+                (capability, enabled) = cap
+                self.add_capability(host, capability(), enable_state=enabled)
+
+        return host
+
+    def add_iface(self, host, name, is_external, fib=FIB.DEFAULT, hostiface=None, type_=NetifType.PHYSICAL, deployment=None):
+        iface =\
+            self.add(OAG_NetIface,
+                host=host,
+                name=name,
+                type=type_,
+                mac=str(),
+                fib=fib,
+                is_external=is_external,
+                wireless=False,
+                deployment=deployment
+            )
+
+        # If it's a VLAN, fib is the same is the host interface
+        if type_==NetifType.VLAN:
+            if hostiface['fib']!=fib:
+                raise OAError("Parent interface has different fib from given one")
+            if hostiface['is_external']:
+                raise OAError("Can't put a VLAN on an external interface")
+            iface['fib']      = hostiface['fib']
+            iface['vlanhost'] = hostiface
+
+        # See if this interface is being routed by another interface
+        if type_==NetifType.PHYSICAL and not self.is_bastion(host) and not is_external:
+            bastion = self.bastion(host['site'])
+            if not bastion:
+                raise OAError(f"[{name}] on [{host['name']}] needs a site bastion to route it")
+            iface['routed_by'] = self.routed_subnets(bastion)[len(self.internal_ifaces(host))-1]['routing_iface']
+
+        # Second order effects, as in OAG_Host.add_iface
+        if type_==NetifType.PHYSICAL and self.is_bastion(host) and not is_external:
+            self.record(host['site'], '_reroute_compute_hosts')
+            self.assign_subnet(SubnetType.SITE, hosts_expected=1000, iface=iface, dynamic_hosts=100)
+
+        if type_==NetifType.VLAN:
+            self.assign_subnet(
+                SubnetType.DEPLOYMENT,
+                deployment=deployment,
+                hosts_expected=1 if self.is_bastion(host) else 14,
+                iface=iface
+            )
+
+        self.record(host, '_reconcile_dhclients')
+        self.record(host['site'], '_reconcile_site_services')
+        if not is_external:
+            self.record(host, '_enable_bird')
+
+        return iface
+
+    def add_capability(self, host, capdef, enable_state=None, fib=FIB.DEFAULT, custom_pkg=False):
+        """Run a capability on a host, unless it already runs one of the same name"""
+        if self.select(OAG_Capability, host=host, service=capdef.name):
+            return
+        if capdef.mounts:
+            raise OAError("Mounts not supported for baremetal caps")
+
+        cap =\
+            self.add(OAG_Capability,
+                deployment=None,
+                host=host,
+                service=capdef.name,
+                stripe=0,
+                stripe_group=capdef.name,
+                affinity=None,
+                cores=capdef.cores if capdef.cores else 0,
+                memory=capdef.memory if capdef.memory else 0,
+                start_rc=enable_state,
+                start_local=False,
+                fib=fib,
+                expose=None,
+                secure=False,
+                custom_pkg=custom_pkg
+            )
+
+        if capdef.setknobs_exist:
+            for knob, value in capdef.set_knobs.items():
+                self.add(OAG_CapabilityKnob, capability=cap, knob=knob, value=value)
+
+        return cap
+
+    def add_deployment_capability(self, depl, capdef, enable_state=True, affinity=None, stripes=1, stripe_group=None, max_stripes=None, expose=None, external_alias=[], secure=False, custom_pkg=False, acls=[]):
+        """Planned equivalent of OAG_Deployment.add_capability"""
+        if not capdef.jailable:
+            raise OAError(f"Capability [{capdef.name}] is not jailable and cannot be added to deployment")
+        if expose and not external_alias:
+            raise OAError(f"Exposed capability [{capdef.name}] *must* have external DNS alias")
+
+        stripe_group = capdef.name if not stripe_group else stripe_group
+
+        capabilities = [cap for cap in self.select(OAG_Capability, deployment=depl) if cap['service']==capdef.name]
+        stripe_base = capabilities[-1]['stripe']+1 if capabilities else 0
+
+        if max_stripes and len([cap for cap in capabilities if cap['stripe_group']==stripe_group])>=max_stripes:
+            print(f"====> [{depl['name']}] All necessary [{capdef.name}] stripes for stripe group [{stripe_group}] already running (max {max_stripes})")
+            return
+
+        roles = {role['username']:role for role in self.rows[OAG_Role]}
+        for (username, acl) in set(acls):
+            if username not in roles:
+                raise OAError(f"[{username}] is not a role in [{self.domain.domain}]")
+
+        for stripe in range(stripes):
+            cap =\
+                self.add(OAG_Capability,
+                    deployment=depl,
+                    host=None,
+                    service=capdef.name,
+                    stripe=stripe_base+stripe,
+                    stripe_group=stripe_group,
+                    affinity=affinity,
+                    cores=capdef.cores if capdef.cores else 0,
+                    memory=capdef.memory if capdef.memory else 0,
+                    start_rc=enable_state,
+                    start_local=False,
+                    # OK to set FIB.DEFAULT: containerized capabilities
+                    # are always on the default (internal) routing table
+                    fib=FIB.DEFAULT,
+                    expose=expose,
+                    secure=secure,
+                    custom_pkg=custom_pkg
+                )
+
+            if capdef.setknobs_exist:
+                for knob, value in capdef.set_knobs.items():
+                    self.add(OAG_CapabilityKnob, capability=cap, knob=knob, value=value)
+
+            for alias in external_alias:
+                self.add(OAG_CapabilityAlias, capability=cap, alias=alias, is_external=True)
+
+            for (username, acl) in set(acls):
+                self.add(OAG_CapabilityRole, capability=cap, role=roles[username], acl=acl)
+
+            for (mount, size_gb) in capdef.mounts:
+                self.add(OAG_CapabilityRequiredMount, cap=cap, mount=mount, size_gb=size_gb)
+
+    def assign_subnet(self, type_, hosts_expected=254, iface=None, dynamic_hosts=0, deployment=None):
+        csubnet =\
+            allocate_subnet(
+                type_,
+                [network for (esubtype, network) in self.existing_subnets if esubtype==type_],
+                hosts_expected=hosts_expected,
+                seqnum=deployment['seqnum'] if deployment else None
+            )
+        self.existing_subnets.append((type_, csubnet))
+
+        return\
+            self.add(OAG_Subnet,
+                domain=self.domain,
+                network=str(csubnet.network_address),
+                prefixlen=int(csubnet.prefixlen),
+                type=type_,
+                router=iface['host'] if iface else None,
+                routing_iface=iface,
+                dynamic_hosts=dynamic_hosts
+            )
+
+    ## Topology effects
+
+    def record(self, node, effect):
+        self.pending[(node, effect)] = True
+
+    def apply_effects(self):
+        pending, self.pending = self.pending, collections.OrderedDict()
+        for effect in TopologyBatch.effects:
+            for (node, effect_) in pending:
+                if effect_==effect:
+                    getattr(self, effect)(node)
+
+    def _reroute_compute_hosts(self, site):
+        bastion = self.bastion(site)
+        for host in self.select(OAG_Host, site=site):
+            if host is bastion:
+                continue
+            for i, int_iface in enumerate(self.internal_ifaces(host)):
+                try:
+                    int_iface['routed_by'] = self.routed_subnets(bastion)[i]['routing_iface']
+                    int_iface['fib'] = FIB.DEFAULT
+                except IndexError:
+                    raise OAError("Unable to find corresponding internal routing interface")
+
+    def _reconcile_dhclients(self, host):
+        dhcp_ifaces = [iface for iface in self.physical_ifaces(host) if self.routingstyle(iface)==RoutingStyle.DHCP]
+        fibs = self.fibs(host)
+        if len(dhcp_ifaces)>1 and len(fibs)>1:
+            for i, fib in enumerate(fibs):
+                self.add(OAG_Capability,
+                    deployment=None,
+                    host=host,
+                    service=dhc.name,
+                    stripe=0,
+                    stripe_group=dhc.name,
+                    affinity=None,
+                    cores=dhc.cores if dhc.cores else 0,
+                    memory=dhc.memory if dhc.memory else 0,
+                    start_rc=False,
+                    start_local=True,
+                    start_local_prms=dhcp_ifaces[i]['name'],
+                    fib=fib,
+                    expose=None,
+                    secure=False,
+                    custom_pkg=False
+                )
+
+    def _reconcile_site_services(self, site):
+        bastion = self.bastion(site)
+        if bastion:
+            # DHCP
+            dhcpd_ifaces = ' '.join([iface['name'] for iface in self.internal_ifaces(bastion) if self.dhcpd_enabled(iface)])
+            self.add_capability(bastion, dhcpd().setknob('ifaces', dhcpd_ifaces), enable_state=True)
+
+            # DNS
+            self.add_capability(bastion, named(), enable_state=True)
+
+            # Turn off cloud-provided resolvconf
+            for host in self.select(OAG_Host, site=site):
+                self.add_capability(host, resolvconf())
+
+    def _enable_bird(self, host):
+        self.add_capability(host, bird(), enable_state=True)
+
+    ## Insert
+
+    def value(self, value):
+        """Column value of a planned field"""
+        if isinstance(value, (PlannedRow, OAG_RootNode)):
+            return value.id
+        elif isinstance(value, enum.Enum):
+            return value.value
+        else:
+            return value
+
+    def insert(self):
+        """Insert every planned row in one transaction, a batch of
+        LOADER_BATCH_ROWS rows per statement"""
+        with pooled_connection() as dbconn:
+            for oagcls in self.tables:
+                rows = self.rows[oagcls]
+                if not rows:
+                    continue
+
+                selfrefs = [field for field, spec in oagcls.streams.items() if spec[0] is oagcls]
+                ids =\
+                    dbinsert(
+                        dbconn,
+                        oagcls,
+                        [{field:self.value(value) for field, value in row.values.items() if field not in selfrefs} for row in rows],
+                        batch_rows=LOADER_BATCH_ROWS
+                    )
+                for row, id_ in zip(rows, ids):
+                    row.id = id_
+
+                linked = [(row.id, {field:self.value(row[field]) for field in selfrefs}) for row in rows if any([row[field] for field in selfrefs])]
+                if linked:
+                    dbupdate_keys(dbconn, oagcls, selfrefs, linked, batch_rows=LOADER_BATCH_ROWS)
+
+def _template(name, spec):
+    """Turn a template spec into a HostTemplate subclass"""
+    attrs = {}
+    for attr, value in spec.items():
+        if attr=='os':
+            value = HostOS[value]
+        elif attr=='interfaces':
+            value = [tuple(iface[:2])+tuple(frieze.FIB[fib] for fib in iface[2:]) for iface in value]
+        elif attr=='sysctls':
+            value = [(Tunable[tunable], TunableType[type_], v) for (tunable, type_, v) in value]
+        elif attr=='caps':
+            value = [(getattr(frieze.capability, cap[0]),)+tuple(cap[1:]) for cap in value]
+        attrs[attr] = value
+    return type(name, (HostTemplate,), attrs)
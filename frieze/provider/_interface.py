@@ -22,15 +22,27 @@ class CloudInterface(object):
     def block_rootdisk(self):
         raise NotImplementedError("No implementation yet")
 
+    def dns_change_insync(self, change_id):
+        raise NotImplementedError("No implementation yet")
+
     def dns_list_zones(self, name=None):
         raise NotImplementedError("No implementation yet")
 
     def dns_list_records(self, zone, types=[]):
         raise NotImplementedError("No implementation yet")
 
+    def dns_nameservers(self, zone):
+        raise NotImplementedError("No implementation yet")
+
     def dns_upsert_record(self, vsubid, domain, alias, ip, ttl=60, type_='A'):
         raise NotImplementedError("No implementation yet")
 
+    def dns_upsert_records(self, vsubid, records, ttl=60, type_='A'):
+        raise NotImplementedError("No implementation yet")
+
+    def dns_wait_insync(self, change_ids):
+        raise NotImplementedError("No implementation yet")
+
     def network_attach(self, host, network):
         raise NotImplementedError("No implementation yet")
 
@@ -6,6 +6,11 @@ from openarc import oaenv
 
 from ._interface import CloudInterface
 
+# Route53 accepts at most 1000 records and 32000 characters of values per
+# change batch. UPSERTs count twice against both.
+ROUTE53_BATCH_RECORDS = 500
+ROUTE53_BATCH_CHARS   = 16000
+
 class AwsShim(CloudInterface):
 
     def __init__(self, apikey):
@@ -29,18 +34,31 @@ class AwsShim(CloudInterface):
         return api_ret
 
     def dns_list_records(self, zone, types=[]):
-        """EXPLICITLY does not support multiple values for any given record"""
-        api_ret = self.api.list_resource_record_sets(HostedZoneId=zone['vsubid'])
-        return [{
-            'vsubid' : zone['vsubid'],
-            'name'   : rr['Name'][:-1],
-            'type'   : rr['Type'],
-            'value'  : rr['ResourceRecords'][0]['Value'],
-            'asset'  : rr
-        } for rr in api_ret['ResourceRecordSets'] if (rr['Type'] in types if types else True)]
+        """Yield records in zone, a page at a time. EXPLICITLY does not
+        support multiple values for any given record"""
+        paginator = self.api.get_paginator('list_resource_record_sets')
+        for page in paginator.paginate(HostedZoneId=zone['vsubid']):
+            for rr in page['ResourceRecordSets']:
+                if types and rr['Type'] not in types:
+                    continue
+                yield {
+                    'vsubid' : zone['vsubid'],
+                    'name'   : rr['Name'][:-1],
+                    'type'   : rr['Type'],
+                    'value'  : rr['ResourceRecords'][0]['Value'] if rr.get('ResourceRecords') else None,
+                    'asset'  : rr
+                }
+
+    def dns_change_insync(self, change_id):
+        """True once Route53 has applied change_id on all its nameservers"""
+        return self.api.get_change(Id=change_id)['ChangeInfo']['Status']=='INSYNC'
+
+    def dns_nameservers(self, zone):
+        return self.api.get_hosted_zone(Id=zone['vsubid'])['DelegationSet']['NameServers']
 
     def dns_upsert_record(self, vsubid, key, value, ttl=60, type_='A'):
-        self.api.change_resource_record_sets(
+        """Returns the id of the change, see dns_change_insync()"""
+        api_ret = self.api.change_resource_record_sets(
             HostedZoneId=vsubid,
             ChangeBatch={
                 'Changes' : [{
@@ -56,3 +74,48 @@ class AwsShim(CloudInterface):
                 }]
             }
         )
+        return api_ret['ChangeInfo']['Id']
+
+    def dns_upsert_records(self, vsubid, records, ttl=60, type_='A'):
+        """Upsert {key : value or [values]} in as few changes as Route53's
+        batch limits allow. Returns the ids of the changes, see
+        dns_change_insync() and dns_wait_insync()"""
+        batches = [[]]
+        (batch_records, batch_chars) = (0, 0)
+        for key, values in records.items():
+            if type(values)!=list:
+                values = [values]
+            values = ['"%s"' % value if type_=='TXT' else value for value in values]
+            chars = sum([len(value) for value in values])
+            if batches[-1] and (batch_records+len(values)>ROUTE53_BATCH_RECORDS or batch_chars+chars>ROUTE53_BATCH_CHARS):
+                batches.append([])
+                (batch_records, batch_chars) = (0, 0)
+            batch_records += len(values)
+            batch_chars   += chars
+            batches[-1].append({
+                'Action' : 'UPSERT',
+                'ResourceRecordSet':{
+                    'Name'  : key,
+                    'Type'  : type_,
+                    'TTL'   : ttl,
+                    'ResourceRecords' : [{
+                        'Value' : value
+                    } for value in values]
+                }
+            })
+
+        return [
+            self.api.change_resource_record_sets(
+                HostedZoneId=vsubid,
+                ChangeBatch={
+                    'Changes' : changes
+                }
+            )['ChangeInfo']['Id']
+            for changes in batches if changes
+        ]
+
+    def dns_wait_insync(self, change_ids):
+        """Block until Route53 has applied every change in change_ids"""
+        waiter = self.api.get_waiter('resource_record_sets_changed')
+        for change_id in change_ids:
+            waiter.wait(Id=change_id)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+__all__ = ['RollingDeploy']
+
+import collections
+import subprocess
+import time
+
+from openarc import oaenv
+from openarc.exception import OAError
+
+# A container, as far as rolling deploys are concerned
+Placement = collections.namedtuple('Placement', ['stripe_group', 'fqdn', 'ip4', 'ports'])
+
+class RollingDeploy(object):
+    """Pushes hosts in batches that are allowed to restart together. No
+    stripe group has more than {max_unavailable} of its stripes (but always at
+    least one) on the hosts of a batch, so every group keeps serving while a
+    batch restarts, and no batch has more than {max_batch} hosts. Bastions and
+    routers carry traffic for everything behind them, and are pushed on their
+    own.
+
+    Hosts are pushed as soon as they are rendered. Before a host that doesn't
+    fit in the current batch goes out, wait_healthy() blocks until the batch
+    is back: hosts that rebooted have a new boot time, and every port of every
+    capability on them accepts connections. A batch that doesn't come back
+    within {timeout} seconds aborts the deploy."""
+
+    def __init__(self, domain, max_unavailable=None, max_batch=None, timeout=None, interval=5):
+        try:
+            self.max_unavailable = max_unavailable if max_unavailable else oaenv('frieze').deploy.max_unavailable
+            self.max_batch       = max_batch if max_batch else oaenv('frieze').deploy.max_batch
+            self.timeout         = timeout if timeout else oaenv('frieze').deploy.health_timeout
+        except (AttributeError, KeyError):
+            self.max_unavailable = max_unavailable if max_unavailable else 0.5
+            self.max_batch       = max_batch if max_batch else 8
+            self.timeout         = timeout if timeout else 300
+        self.interval = interval
+
+        # Placement is computed once: host.containers would redo it per host
+        self.stripes   = collections.Counter()
+        self.placement = collections.defaultdict(list)
+        for container in domain.containers:
+            stripe_group = (container.deployment.name, container.stripe_group)
+            self.stripes[stripe_group] += 1
+            self.placement[container.host.id].append(
+                Placement(stripe_group, container.fqdn, container.ip4(), list(container.capability.c_capability.ports or []))
+            )
+
+    def allowance(self, group):
+        """Stripes of group that may be down at once"""
+        return max(1, int(self.stripes[group]*self.max_unavailable))
+
+    def run(self, configs, push, id_file):
+        """Push each (host, tarball) pair from configs with push(host,
+        tarball) as soon as it arrives. push returns what wait_healthy()
+        expects for the host: (host, boot time before the push, whether the
+        push reboots it)."""
+        from frieze._core import HostRole
+
+        (batch, down, solo) = ([], collections.Counter(), False)
+        for host, host_tar in configs:
+            groups = collections.Counter([placement.stripe_group for placement in self.placement[host.id]])
+            host_solo = host.role in (HostRole.SITEBASTION, HostRole.SITEROUTER)
+            fits =\
+                not solo and not host_solo\
+                and len(batch)<self.max_batch\
+                and all([down[group]+count<=self.allowance(group) for group, count in groups.items()])
+            if batch and not fits:
+                self.wait_healthy(batch, id_file)
+                (batch, down) = ([], collections.Counter())
+            batch.append(push(host, host_tar))
+            down.update(groups)
+            solo = host_solo
+        if batch:
+            self.wait_healthy(batch, id_file)
+
+    def boottime(self, host, id_file):
+        """Return the boot time reported by host, or None if it is unreachable"""
+        output = self.remote(host, id_file, 'sysctl -n kern.boottime')
+        return output.stdout if output.returncode==0 else None
+
+    def remote(self, host, id_file, cmd):
+        from frieze._core import FIB
+        return subprocess.run(
+                   f'ssh -o ConnectTimeout={self.interval} root@{host.ip4(fib=FIB.WORLD)} -i {id_file} "{cmd}"',
+                   shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+               )
+
+    def wait_healthy(self, batch, id_file):
+        """Block until every host in batch, a list of (host, boot time before
+        the push, whether the push reboots it), is serving again"""
+        deadline = time.monotonic()+self.timeout
+
+        def wait(check, desc):
+            while not check():
+                if time.monotonic()>deadline:
+                    raise OAError(f"{desc} not healthy after {self.timeout} seconds, aborting deploy")
+                time.sleep(self.interval)
+
+        for host, boottime, reboots in batch:
+            if reboots:
+                print(f'Waiting for {host.fqdn} to reboot')
+                wait(lambda: self.boottime(host, id_file) not in (None, boottime), host.fqdn)
+
+            for placement in self.placement[host.id]:
+                for port in placement.ports:
+                    print(f'Waiting for {placement.fqdn} on port {port}')
+                    cmd = f'nc -z -w {self.interval} {placement.ip4} {port}'
+                    wait(lambda: self.remote(host, id_file, cmd).returncode==0, f'{placement.fqdn}:{port}')
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+__all__ = ['export_snapshot', 'load_snapshot', 'snapshot_data', 'SnapshotCollection', 'SnapshotGraph', 'SnapshotNode']
+
+import enum
+import gzip
+import inspect
+import json
+import openarc
+import re
+import types
+
+from openarc import OAG_RootNode
+from openarc.exception import OAError
+
+import frieze
+
+from frieze._core import\
+    OAG_Capability, OAG_CapabilityAlias, OAG_CapabilityKnob,\
+    OAG_CapabilityRequiredMount, OAG_CapabilityRole, OAG_Container,\
+    OAG_Deployment, OAG_Domain, OAG_Host, OAG_NetIface, OAG_Role, OAG_Site,\
+    OAG_Subnet, OAG_Sysctl, OAG_SysMount
+
+# Version of the on-disk format
+SNAPSHOT_VERSION = 1
+
+# Every node class that can appear in a snapshot
+p_snapshot_classes = [
+    OAG_Capability,
+    OAG_CapabilityAlias,
+    OAG_CapabilityKnob,
+    OAG_CapabilityRequiredMount,
+    OAG_CapabilityRole,
+    OAG_Container,
+    OAG_Deployment,
+    OAG_Domain,
+    OAG_Host,
+    OAG_NetIface,
+    OAG_Role,
+    OAG_Site,
+    OAG_Subnet,
+    OAG_Sysctl,
+    OAG_SysMount,
+]
+
+# Reverse streams to walk when exporting, starting from the domain
+p_export_streams = {
+    OAG_Domain     : ['site', 'deployment', 'subnet', 'role'],
+    OAG_Site       : ['host'],
+    OAG_Host       : ['net_iface', 'sysctl', 'capability'],
+    OAG_Deployment : ['capability'],
+    OAG_Capability : ['capability_knob', 'capability_alias', 'capability_role', 'capability_required_mount'],
+}
+
+# Containers and block storage aren't stored in the database: they are derived
+# by the placement algorithm. Snapshots keep the result, so that loading one
+# doesn't require re-running placement.
+p_computed_streams = {
+    OAG_Domain : {'containers'    : OAG_Container},
+    OAG_Site   : {'block_storage' : OAG_SysMount},
+}
+
+def dbtable(oagcls):
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', oagcls.__name__[4:]).lower()
+
+def is_oagclass(streamtype):
+    return inspect.isclass(streamtype) and issubclass(streamtype, OAG_RootNode)
+
+def reverse_streams(oagcls):
+    """Return {name : (referencing class, field)} for the reverse streams of
+    oagcls. Reverse streams are named after the referencing table, qualified
+    by the field if the table refers to oagcls more than once."""
+    rv = {}
+    for srccls in p_snapshot_classes:
+        if srccls in (OAG_Container, OAG_SysMount):
+            continue
+        fields = [field for field, spec in srccls.streams.items() if spec[0] is oagcls]
+        for field in fields:
+            name = dbtable(srccls) if len(fields)==1 else f'{dbtable(srccls)}_{field}'
+            rv[name] = (srccls, field)
+    return rv
+
+def dbrows(cur, oagcls, field, ids):
+    """Return {id : {field : column value}} for the rows of oagcls whose
+    field refers to one of ids, or whose own id is one of ids if field is
+    None. Column names are openarc's."""
+    if not ids:
+        return {}
+
+    node = oagcls()
+    columns = node.stream_db_mapping
+    keycol = node.dbpkname if field is None else columns[field]
+    cur.execute(SQL.rows_by_key % (oagcls.context, node.dbtable, keycol), (ids,))
+    return {row[node.dbpkname]:{field:row[column] for field, column in columns.items()} for row in cur.fetchall()}
+
+def load_rows(domain):
+    """Read the stored rows of a domain version with one query per reverse
+    stream in p_export_streams, keyed on the ids of every parent read before
+    it. Returns {class : {id : {field : column value}}}."""
+    import psycopg2
+    import psycopg2.extras
+
+    rows = {}
+    dbconn = psycopg2.connect(**{k:v for k, v in openarc.oaenv.dbinfo.items() if k!='on_demand_schema'})
+    try:
+        with dbconn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            rows[OAG_Domain] = dbrows(cur, OAG_Domain, None, [domain.id])
+            for oagcls, streams in p_export_streams.items():
+                for stream in streams:
+                    (srccls, field) = reverse_streams(oagcls)[stream]
+                    rows.setdefault(srccls, {}).update(dbrows(cur, srccls, field, list(rows.get(oagcls, {}))))
+    finally:
+        dbconn.close()
+
+    return rows
+
+def snapshot_data(domain):
+    """Return a frozen domain in snapshot format. Strings are interned in a
+    single table, and each row is stored as a list of values in stream order.
+    Stored rows are read by load_rows(), derived nodes are computed from the
+    database graph."""
+    if not domain.is_frozen:
+        raise OAError("Can't export domain that hasn't been snapshotted")
+
+    strings = {}
+    def intern(value):
+        try:
+            return strings[value]
+        except KeyError:
+            strings[value] = len(strings)
+            return strings[value]
+
+    def encode(value, streamtype):
+        if value is None:
+            return None
+        elif is_oagclass(streamtype):
+            return value if isinstance(value, int) else value.id
+        elif inspect.isclass(streamtype) and issubclass(streamtype, enum.Enum):
+            return intern(streamtype(value).name)
+        elif streamtype in ('text', 'timestamp'):
+            return intern(str(value))
+        else:
+            return value
+
+    nodes = {oagcls.__name__:{} for oagcls in p_snapshot_classes}
+    for oagcls, rows in load_rows(domain).items():
+        for id_, row in rows.items():
+            nodes[oagcls.__name__][id_] =\
+                [id_] + [encode(row[field], spec[0]) for field, spec in oagcls.streams.items()]
+
+    # Synthetic ids are assigned to derived nodes in the order they're found
+    computed = {}
+    for oagcls, streams in p_computed_streams.items():
+        for id_ in list(nodes[oagcls.__name__]):
+            node = oagcls(id_)
+            for stream, payloadcls in streams.items():
+                members = []
+                payload = getattr(node, stream)
+                if payload and payload.size>0:
+                    for subnode in payload:
+                        subid = len(nodes[payloadcls.__name__])+1
+                        nodes[payloadcls.__name__][subid] =\
+                            [subid] + [encode(getattr(subnode, field, None), spec[0]) for field, spec in payloadcls.streams.items()]
+                        members.append(subid)
+                computed.setdefault(oagcls.__name__, {}).setdefault(str(id_), {})[stream] = members
+
+    return {
+        'version'  : SNAPSHOT_VERSION,
+        'root'     : domain.id,
+        'strings'  : sorted(strings, key=strings.get),
+        'fields'   : {oagcls.__name__:list(oagcls.streams.keys()) for oagcls in p_snapshot_classes},
+        'nodes'    : {clsname:list(rows.values()) for clsname, rows in nodes.items()},
+        'computed' : computed,
+    }
+
+def export_snapshot(domain, path):
+    """Write a frozen domain to path as JSON, gzipped if path ends in .gz"""
+    payload = json.dumps(snapshot_data(domain), separators=(',', ':')).encode()
+
+    with (gzip.open if path.endswith('.gz') else open)(path, 'wb') as f:
+        f.write(payload)
+
+    return path
+
+def load_snapshot(path):
+    """Load a snapshot written by export_snapshot() and return its domain. The
+    graph is read-only and lives entirely in memory: no database connection is
+    used to navigate or render it."""
+    frieze.init()
+
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+        data = json.loads(f.read().decode())
+
+    if data['version']!=SNAPSHOT_VERSION:
+        raise OAError(f"Unsupported snapshot version [{data['version']}]")
+
+    return SnapshotGraph(data).domain
+
+class SnapshotCollection(object):
+    """In-memory stand-in for an OAG collection. Unlike OAG collections,
+    iteration yields distinct nodes, so there is no cursor to corrupt.
+    Attributes not defined here are read from the first node, the way a
+    freshly loaded OAG collection would answer them."""
+    def __init__(self, nodes):
+        self._nodes = list(nodes)
+
+    def __bool__(self):
+        return len(self._nodes)>0
+
+    def __getattr__(self, attr):
+        if attr.startswith('_') or not self._nodes:
+            raise AttributeError(attr)
+        return getattr(self._nodes[0], attr)
+
+    def __getitem__(self, idx):
+        return self._nodes[idx]
+
+    def __iter__(self):
+        for i, node in enumerate(self._nodes):
+            node._iteridx = i
+            yield node
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def clone(self):
+        return SnapshotCollection(self._nodes)
+
+    def filter(self, predicate):
+        self._nodes = [node for node in self._nodes if predicate(node)]
+        return self
+
+    @property
+    def rdf(self):
+        return self
+
+    @property
+    def size(self):
+        return len(self._nodes)
+
+class SnapshotNode(object):
+    """Read-only, in-memory stand-in for a node of class {oagclass}. Streams
+    are served from the snapshot. Everything else (properties, oagprops and
+    methods) is borrowed from {oagclass} and evaluated against this node, so
+    the snapshot renders with exactly the same code as the database."""
+
+    oagclass = None
+
+    def __init__(self, graph, id_, row):
+        self._graph   = graph
+        self._iteridx = 0
+        self._row     = row
+        self.id       = id_
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        graph = self.__dict__['_graph']
+        row = self.__dict__['_row']
+        if attr in row:
+            return graph.decode(self.oagclass, attr, row[attr])
+
+        key = (self.oagclass, self.id)
+        if attr in graph.computed.get(key, {}):
+            return SnapshotCollection(graph.computed[key][attr])
+
+        if attr in graph.reverse_streams(self.oagclass):
+            members = graph.reverse.get(key, {}).get(attr)
+            return SnapshotCollection(members) if members else None
+
+        borrowed = inspect.getattr_static(self.oagclass, attr)
+        if hasattr(borrowed, 'fget'):
+            return borrowed.fget(self)
+        elif isinstance(borrowed, types.FunctionType):
+            return types.MethodType(borrowed, self)
+        elif hasattr(borrowed, '__get__'):
+            return borrowed.__get__(self, self.oagclass)
+        else:
+            return borrowed
+
+    def __getitem__(self, idx):
+        if idx not in (0, -1):
+            raise IndexError(idx)
+        return self
+
+    def __iter__(self):
+        yield self
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}[{self.id}]>'
+
+    def clone(self):
+        return self
+
+    def is_oagnode(self, stream):
+        return is_oagclass(self.oagclass.streams[stream][0])
+
+    def prefetch(self):
+        return self
+
+    def prefetched(self, stream, refresh=False, copy=True):
+        return getattr(self, stream, None)
+
+    @property
+    def root_domain(self):
+        return self._graph.domain
+
+    @property
+    def size(self):
+        return 1
+
+class SnapshotGraph(object):
+    def __init__(self, data):
+        self.strings  = data['strings']
+        self.classes  = {oagcls.__name__:oagcls for oagcls in p_snapshot_classes}
+        self.nodes    = {}
+        self.reverse  = {}
+        self.computed = {}
+        self._reverse_streams = {}
+        self._nodeclasses = {}
+
+        for clsname, rows in data['nodes'].items():
+            oagcls = self.classes[clsname]
+            nodecls = self.nodeclass(oagcls)
+            fields = data['fields'][clsname]
+            for row in rows:
+                self.nodes[(oagcls, row[0])] = nodecls(self, row[0], dict(zip(fields, row[1:])))
+
+        # Derived nodes only hang off their computed streams
+        for (oagcls, id_), node in self.nodes.items():
+            if oagcls in (OAG_Container, OAG_SysMount):
+                continue
+            for field, spec in oagcls.streams.items():
+                if is_oagclass(spec[0]) and node._row[field] is not None:
+                    name = self.reverse_name(spec[0], oagcls, field)
+                    self.reverse.setdefault((spec[0], node._row[field]), {}).setdefault(name, []).append(node)
+
+        for clsname, members in data['computed'].items():
+            oagcls = self.classes[clsname]
+            for id_, streams in members.items():
+                self.computed[(oagcls, int(id_))] = {
+                    stream:[self.nodes[(p_computed_streams[oagcls][stream], subid)] for subid in subids]
+                    for stream, subids in streams.items()
+                }
+
+        self.domain = self.nodes[(OAG_Domain, data['root'])]
+
+    def decode(self, oagcls, field, value):
+        if value is None:
+            return None
+        streamtype = oagcls.streams[field][0]
+        if is_oagclass(streamtype):
+            return self.nodes[(streamtype, value)]
+        elif inspect.isclass(streamtype) and issubclass(streamtype, enum.Enum):
+            return streamtype[self.strings[value]]
+        elif streamtype in ('text', 'timestamp'):
+            return self.strings[value]
+        else:
+            return value
+
+    def nodeclass(self, oagcls):
+        try:
+            return self._nodeclasses[oagcls]
+        except KeyError:
+            self._nodeclasses[oagcls] = type(f'Snapshot{oagcls.__name__[4:]}', (SnapshotNode,), {'oagclass' : oagcls})
+            return self._nodeclasses[oagcls]
+
+    def reverse_name(self, oagcls, srccls, field):
+        for name, (c, f) in self.reverse_streams(oagcls).items():
+            if (c, f)==(srccls, field):
+                return name
+
+    def reverse_streams(self, oagcls):
+        try:
+            return self._reverse_streams[oagcls]
+        except KeyError:
+            self._reverse_streams[oagcls] = reverse_streams(oagcls)
+            return self._reverse_streams[oagcls]
+
+class SQL(object):
+    rows_by_key =\
+        "SELECT * FROM %s.%s WHERE %s=ANY(%%s)"
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+sys.path.append('../..')
+
+from frieze.artifact import ArtifactStore
+
+def tarball(members):
+    tarout = io.BytesIO()
+    with tarfile.open(fileobj=tarout, mode='w') as tar:
+        for name, payload in members.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(payload)
+            tar.addfile(tarinfo, io.BytesIO(payload))
+    return tarout.getvalue()
+
+class TestArtifactStore(unittest.TestCase):
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.store = ArtifactStore(self.td.name)
+
+    def tearDown(self):
+        self.td.cleanup()
+
+    def objects(self):
+        return sorted([prefix+name for prefix in os.listdir(self.store.objects_dir) for name in os.listdir(os.path.join(self.store.objects_dir, prefix))])
+
+    def test_content_addressing(self):
+        manifest1 = self.store.add('v1', 'host1', tarball({'00001-rc.conf' : b'a', '00002-motd' : b'shared'}))
+        manifest2 = self.store.add('v1', 'host2', tarball({'00001-rc.conf' : b'b', '00002-motd' : b'shared'}))
+
+        # Identical payloads are stored once
+        self.assertEqual(manifest1['00002-motd'], manifest2['00002-motd'])
+        self.assertEqual(len(self.objects()), 3)
+        self.assertEqual(self.store.get(manifest1['00001-rc.conf']), b'a')
+        self.assertEqual(self.store.manifest('v1', 'host2'), manifest2)
+
+        # Materialized files are links to the stored objects
+        target = os.path.join(self.store.deploy_dir, 'v1', 'host1', '00002-motd')
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b'shared')
+        self.assertTrue(os.path.samefile(target, self.store.object_path(manifest1['00002-motd'])))
+
+    def test_gc_keeps_newest(self):
+        for i in range(4):
+            self.store.add(f'v{i}', 'host1', tarball({'00001-rc.conf' : f'version {i}'.encode(), '00002-motd' : b'shared'}))
+            # Versions are ordered by manifest directory mtime
+            os.utime(os.path.join(self.store.manifests_dir, f'v{i}'), ns=(i*10**9, i*10**9))
+
+        self.assertEqual(self.store.gc(keep=2), 2)
+        self.assertEqual(self.store.versions(), ['v2', 'v3'])
+        self.assertFalse(os.path.exists(os.path.join(self.store.deploy_dir, 'v0')))
+
+        # Everything the remaining versions refer to is still there
+        for version in ('v2', 'v3'):
+            for digest in self.store.manifest(version, 'host1').values():
+                self.assertTrue(os.path.exists(self.store.object_path(digest)))
+        self.assertEqual(len(self.objects()), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import sys
+import tarfile
+import unittest
+sys.path.append('../..')
+
+from frieze.capability.configinit import ConfigFile, ConfigInit, MANIFEST_FILE, member_target
+
+class TestDelta(unittest.TestCase):
+    """ConfigInit.delta() only sends a host what it doesn't already have"""
+
+    reboot = ['bectl create v2', 'bectl activate v2', 'shutdown -r now']
+
+    def tarball(self, files, knobs=None):
+        cfgen = {ConfigFile.RC_CONF : knobs if knobs else {'hostname' : 'host1'}}
+        for target, payload in files.items():
+            cfgen[target] = f'>{target}\n{payload}'
+        cfgen[ConfigFile.POST_COMMAND_LIST] = list(self.reboot)
+        apply = {target:[f'service {target.split("/")[-1]} restart'] for target in files}
+        return ConfigInit(cfgen, apply=apply, reboot=list(self.reboot)).generate()
+
+    def members(self, tarball):
+        """Return {target file, or archive name for commands : content}"""
+        with tarfile.open(fileobj=io.BytesIO(tarball), mode='r') as tar:
+            members = [(member.name, tar.extractfile(member).read()) for member in tar.getmembers()]
+        return {member_target(content) or name:content for (name, content) in members}
+
+    def manifest(self, tarball):
+        content = self.members(tarball)[MANIFEST_FILE]
+        return json.loads(content[content.find(b'\n')+1:].decode())
+
+    def commands(self, tarball):
+        return [content[3:].decode() for content in self.members(tarball).values() if content[:2]==b'#!']
+
+    def test_unchanged_dropped(self):
+        tarball = self.tarball({'/etc/motd' : 'hello', '/etc/issue' : 'welcome'})
+        delta = self.members(ConfigInit.delta(tarball, self.manifest(tarball)))
+
+        self.assertNotIn('/etc/motd', delta)
+        self.assertNotIn('/etc/issue', delta)
+        self.assertNotIn(ConfigFile.RC_CONF.value, delta)
+        self.assertIn(MANIFEST_FILE, delta)
+        # Commands are always kept
+        self.assertEqual(self.commands(ConfigInit.delta(tarball, self.manifest(tarball))), self.reboot)
+
+    def test_changed_and_new_kept(self):
+        applied = self.manifest(self.tarball({'/etc/motd' : 'hello', '/etc/issue' : 'welcome'}))
+        tarball = self.tarball({'/etc/motd' : 'goodbye', '/etc/issue' : 'welcome', '/etc/hosts.allow' : 'ALL'})
+        delta = self.members(ConfigInit.delta(tarball, applied))
+
+        self.assertEqual(delta['/etc/motd'], b'>/etc/motd\ngoodbye')
+        self.assertIn('/etc/hosts.allow', delta)
+        self.assertNotIn('/etc/issue', delta)
+        self.assertEqual(self.manifest(tarball), json.loads(delta[MANIFEST_FILE][delta[MANIFEST_FILE].find(b'\n')+1:].decode()))
+
+    def test_removed_deleted(self):
+        applied = self.manifest(self.tarball({'/etc/motd' : 'hello', '/etc/issue' : 'welcome'}))
+        tarball = self.tarball({'/etc/motd' : 'hello'})
+
+        self.assertIn("rm -f /etc/issue", self.commands(ConfigInit.delta(tarball, applied)))
+
+    def test_no_manifest(self):
+        # A host that never recorded a manifest has nothing in common with
+        # the new configuration
+        tarball = self.tarball({'/etc/motd' : 'hello'})
+        delta = ConfigInit.delta(tarball, {'files' : {}, 'knobs' : {}, 'apply' : {}, 'reboot' : []})
+        self.assertEqual(set(self.members(delta)), set(self.members(tarball)))
+
+        # A tarball without a manifest can't be diffed, and is sent whole
+        tarout = io.BytesIO()
+        with tarfile.open(fileobj=tarout, mode='w') as tar:
+            tarinfo = tarfile.TarInfo('00000-etc_motd')
+            tarinfo.size = len(b'>/etc/motd\nhello')
+            tar.addfile(tarinfo, io.BytesIO(b'>/etc/motd\nhello'))
+        self.assertEqual(ConfigInit.delta(tarout.getvalue(), self.manifest(tarball)), tarout.getvalue())
+
+    def test_reload(self):
+        applied = self.manifest(self.tarball({'/etc/motd' : 'hello'}))
+
+        # Changes with apply commands are applied live
+        tarball = ConfigInit.delta(self.tarball({'/etc/motd' : 'goodbye'}), applied, reload=True)
+        self.assertEqual(self.commands(tarball), ['service motd restart'])
+        self.assertFalse(ConfigInit.reboots(tarball))
+
+        # rc.conf knobs without one need a reboot
+        tarball = ConfigInit.delta(self.tarball({'/etc/motd' : 'goodbye'}, knobs={'hostname' : 'host2'}), applied, reload=True)
+        self.assertEqual(self.commands(tarball), self.reboot)
+        self.assertTrue(ConfigInit.reboots(tarball))
+
+if __name__ == '__main__':
+    unittest.main()
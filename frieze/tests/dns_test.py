@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import socket
+import sys
+import unittest
+from unittest import mock
+sys.path.append('../..')
+
+from frieze.capability.server.public import DNSPropagation
+from frieze.provider._shim_aws import AwsShim, ROUTE53_BATCH_CHARS, ROUTE53_BATCH_RECORDS
+
+class StubRoute53(object):
+    """Records the change batches sent to it"""
+    def __init__(self):
+        self.batches = []
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self.batches.append(ChangeBatch['Changes'])
+        return {'ChangeInfo' : {'Id' : f'/change/{len(self.batches)}'}}
+
+class StubExtCloud(object):
+    """Changes go in sync after {insync_after} polls"""
+    def __init__(self, insync_after=0, nameservers=['ns1.example.com']):
+        self.insync_after = insync_after
+        self.polls        = 0
+        self._nameservers = nameservers
+
+    def dns_change_insync(self, change_id):
+        self.polls += 1
+        return self.polls>self.insync_after
+
+    def dns_nameservers(self, zone):
+        return self._nameservers
+
+class TestRoute53Batching(unittest.TestCase):
+    def setUp(self):
+        self.shim = AwsShim.__new__(AwsShim)
+        self.shim.api = StubRoute53()
+
+    def records(self, batch):
+        return sum([len(change['ResourceRecordSet']['ResourceRecords']) for change in batch])
+
+    def chars(self, batch):
+        return sum([len(rr['Value']) for change in batch for rr in change['ResourceRecordSet']['ResourceRecords']])
+
+    def test_single_change(self):
+        changes = self.shim.dns_upsert_records('zone', {'_acme-challenge.a' : ['x', 'y'], '_acme-challenge.b' : 'z'}, ttl=5, type_='TXT')
+
+        self.assertEqual(changes, ['/change/1'])
+        (batch,) = self.shim.api.batches
+        self.assertEqual([change['ResourceRecordSet']['Name'] for change in batch], ['_acme-challenge.a', '_acme-challenge.b'])
+        self.assertEqual(batch[0]['ResourceRecordSet']['ResourceRecords'], [{'Value' : '"x"'}, {'Value' : '"y"'}])
+        self.assertEqual(batch[1]['ResourceRecordSet']['TTL'], 5)
+
+    def test_record_limit(self):
+        records = {f'host{i}.example.com' : f'10.0.{i//256}.{i%256}' for i in range(ROUTE53_BATCH_RECORDS*2+1)}
+        changes = self.shim.dns_upsert_records('zone', records)
+
+        self.assertEqual(len(changes), 3)
+        for batch in self.shim.api.batches:
+            self.assertLessEqual(self.records(batch), ROUTE53_BATCH_RECORDS)
+        self.assertEqual(sum([len(batch) for batch in self.shim.api.batches]), len(records))
+
+    def test_char_limit(self):
+        value = 'v'*1000
+        records = {f'_acme-challenge.host{i}' : value for i in range(40)}
+        self.shim.dns_upsert_records('zone', records, type_='TXT')
+
+        self.assertGreater(len(self.shim.api.batches), 1)
+        for batch in self.shim.api.batches:
+            self.assertLessEqual(self.chars(batch), ROUTE53_BATCH_CHARS)
+
+class TestDNSPropagation(unittest.TestCase):
+    def propagation(self, extcloud, served, timeout=1):
+        """served is the list of {name : values} answered by each poll of
+        the nameservers, the last one repeating"""
+        propagation = DNSPropagation(extcloud, {'vsubid' : 'zone'}, timeout=timeout, interval=0.01)
+        propagation.nameservers = lambda: extcloud._nameservers
+        polls = []
+        def txt_values(nameserver, name):
+            polls.append(name)
+            return set(served[min(len(polls)-1, len(served)-1)].get(name, []))
+        propagation.txt_values = txt_values
+        return propagation
+
+    def test_waits_for_change_and_records(self):
+        extcloud = StubExtCloud(insync_after=2)
+        propagation = self.propagation(extcloud, [{}, {'_acme-challenge.a' : ['x']}, {'_acme-challenge.a' : ['x', 'y']}])
+
+        self.assertTrue(propagation.wait({'_acme-challenge.a' : ['x', 'y']}, changes=['/change/1']))
+        self.assertEqual(extcloud.polls, 3)
+
+    def test_times_out(self):
+        propagation = self.propagation(StubExtCloud(), [{}], timeout=0.05)
+        self.assertFalse(propagation.wait({'_acme-challenge.a' : 'x'}))
+
+    def test_no_change_tracking(self):
+        extcloud = StubExtCloud()
+        def dns_change_insync(change_id):
+            raise NotImplementedError
+        extcloud.dns_change_insync = dns_change_insync
+        propagation = self.propagation(extcloud, [{'_acme-challenge.a' : ['x']}])
+
+        self.assertTrue(propagation.wait({'_acme-challenge.a' : 'x'}, changes=['/change/1']))
+
+    def test_unresolved_nameservers(self):
+        extcloud = StubExtCloud()
+        propagation = self.propagation(extcloud, [{'_acme-challenge.a' : ['x']}])
+        del propagation.nameservers
+
+        # Nameservers that don't resolve yet are retried until the deadline
+        lookups = []
+        def gethostbyname(name):
+            lookups.append(name)
+            if len(lookups)<3:
+                raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+            return '192.0.2.1'
+        with mock.patch('socket.gethostbyname', gethostbyname):
+            self.assertTrue(propagation.wait({'_acme-challenge.a' : 'x'}))
+        self.assertEqual(len(lookups), 3)
+
+        with mock.patch('socket.gethostbyname', side_effect=socket.gaierror):
+            propagation.timeout = 0.05
+            self.assertFalse(propagation.wait({'_acme-challenge.a' : 'x'}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ from testhelper import *
 
 # Monkeypatch capabilities and then make them available
 import frieze
+frieze.init()
 frieze.capability.add('~/run/dist/frieze')
 import frieze.capability
 import frieze.hosttype
@@ -105,14 +106,16 @@ class TestSubscriptions(unittest.TestCase, TestBase):
                 'role'      :  frieze.HostRole.SITEBASTION
             })
 
-            # Add compute
+            # Add compute. Site-wide rerouting and service reconciliation is
+            # done once for all hosts when the batch exits.
             print("===> Add compute hosts")
-            for i, hostname in enumerate(['particularjustice', 'ascendantjustice']):
-                host = site.add_host(**{
-                    'template'  : SmallCompute,
-                    'name'      : hostname,
-                    'role'      : frieze.HostRole.COMPUTE
-                })
+            with frieze.TopologyBatch():
+                for i, hostname in enumerate(['particularjustice', 'ascendantjustice']):
+                    host = site.add_host(**{
+                        'template'  : SmallCompute,
+                        'name'      : hostname,
+                        'role'      : frieze.HostRole.COMPUTE
+                    })
 
             # Add in domain identities. add_identity() will create a password if one is not given.
             print("===> Add users")
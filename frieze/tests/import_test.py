@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import subprocess
+import sys
+import unittest
+
+class TestImport(unittest.TestCase):
+    """import frieze should stay cheap: no environment setup, and none of the
+    trust, cloud or templating subsystems until they are used. Modules that
+    openarc itself imports (gevent, cryptography) aren't checked."""
+
+    # Import-time budget, in seconds
+    budget = 2.0
+
+    heavy_modules = [
+        'acme',
+        'bless',
+        'boto3',
+        'josepy',
+        'mako',
+        'pkg_resources',
+        'vultr',
+    ]
+
+    def import_frieze(self, stmt='pass'):
+        script = '\n'.join([
+            'import sys, time',
+            'sys.path.append("../..")',
+            'start = time.perf_counter()',
+            'import frieze',
+            'elapsed = time.perf_counter()-start',
+            stmt,
+            'print(elapsed)',
+            'print(" ".join(sorted(m for m in sys.modules if "." not in m)))',
+        ])
+        rv = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, check=True)
+        (elapsed, modules) = rv.stdout.decode().strip().split('\n')[-2:]
+        return (float(elapsed), modules.split(' '))
+
+    def test_import_is_lazy(self):
+        (elapsed, modules) = self.import_frieze()
+        print(f"import frieze: {elapsed:.3f}s")
+        for module in self.heavy_modules:
+            self.assertNotIn(module, modules)
+        self.assertLess(elapsed, self.budget)
+
+    def test_import_defers_init(self):
+        (elapsed, modules) = self.import_frieze('assert not frieze.p_initialized')
+        self.assertLess(elapsed, self.budget)
+        self.assertNotIn('mako', modules)
+
+if __name__ == '__main__':
+    unittest.main()
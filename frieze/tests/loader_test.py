@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import sys
+import unittest
+sys.path.append('../..')
+from testhelper import *
+
+import frieze
+frieze.init()
+import frieze.capability
+from frieze.loader import load_domain
+
+class TestLoader(unittest.TestCase, TestBase):
+    def setUp(self):
+        self.setUp_db()
+
+    def tearDown(self):
+        self.tearDown_db()
+
+    topology = {
+        'domain' : {'domain' : 'loader.test', 'org' : 'LoaderTest'},
+        'templates' : {
+            'SmallCompute' : {'cores' : 1, 'memory' : 1024, 'bandwidth' : 1024, 'os' : 'FreeBSD_12_0'},
+        },
+        'sites' : [{
+            'name'      : 'Vultr NY1',
+            'shortname' : 'ny1',
+            'provider'  : 'VULTR',
+            'location'  : 'NY',
+            'hosts'     : [
+                {'template' : 'SmallCompute', 'role' : 'SITEBASTION', 'names' : ['installation01']},
+                {'template' : 'SmallCompute', 'role' : 'COMPUTE',     'names' : ['compute01', 'compute02']},
+            ],
+        }],
+        'deployments' : [
+            {'name' : 'app', 'affinity' : 'Vultr NY1'},
+        ],
+    }
+
+    def test_dhclients_have_no_deployment(self):
+        """Deployment VLANs are added in the same topology batch as hosts, and
+        must not leak their deployment into the host's dhclients"""
+        domain = load_domain(self.topology)
+
+        dhclients = 0
+        for site in domain.site:
+            for host in site.host:
+                if host.capability:
+                    for cap in host.capability:
+                        if cap.service=='dhclient':
+                            dhclients += 1
+                            self.assertIsNone(cap.deployment)
+        self.assertGreater(dhclients, 0)
+
+        for depl in domain.deployment:
+            if depl.capability:
+                self.assertNotIn('dhclient', [cap.service for cap in depl.capability])
+
+    class SQL(TestBase.SQL):
+        pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+sys.path.append('../..')
+
+import frieze.capability
+from frieze.capability import registry
+
+class TestRegistry(unittest.TestCase):
+    """Plugin capabilities are found by scanning their source, and imported
+    only when first used"""
+
+    plugin = textwrap.dedent('''
+        from frieze.capability import CapabilityTemplate
+
+        class registrytestbase(CapabilityTemplate):
+            package = 'registrytest'
+            ports   = [8000]
+            knobs   = ['appname']
+
+        class registrytestapp(registrytestbase):
+            ports   = [8080, 8443]
+            memory  = 512 * 2
+
+        class registrytesthelper(object):
+            ports   = [9000]
+    ''')
+
+    def setUp(self):
+        self.td = tempfile.TemporaryDirectory()
+        self.plugindir = os.path.join(self.td.name, 'plugins')
+        os.makedirs(os.path.join(self.plugindir, 'registrytestpkg'))
+        self.write_plugin(self.plugin)
+
+        self.manifest_dir = registry.p_manifest_dir
+        registry.p_manifest_dir = os.path.join(self.td.name, 'cache')
+
+    def tearDown(self):
+        registry.p_manifest_dir = self.manifest_dir
+        for name in ('registrytestbase', 'registrytestapp'):
+            registry.p_registry.pop(name, None)
+            if hasattr(frieze.capability, name):
+                delattr(frieze.capability, name)
+        for module in ('registrytestpkg', 'registrytestpkg.caps'):
+            sys.modules.pop(module, None)
+        if self.plugindir in sys.path:
+            sys.path.remove(self.plugindir)
+        self.td.cleanup()
+
+    def write_plugin(self, source):
+        with open(os.path.join(self.plugindir, 'registrytestpkg', '__init__.py'), 'w') as f:
+            f.write('')
+        with open(os.path.join(self.plugindir, 'registrytestpkg', 'caps.py'), 'w') as f:
+            f.write(source)
+
+    def test_manifest(self):
+        manifest = registry.load_manifest(self.plugindir)
+        capabilities = {entry['name']:entry for entry in manifest['capabilities']}
+
+        self.assertEqual(sorted(capabilities), ['registrytestapp', 'registrytestbase'])
+        self.assertEqual(capabilities['registrytestapp']['module'], 'registrytestpkg.caps')
+        self.assertEqual(capabilities['registrytestapp']['resource_path'], 'registrytestpkg.resources')
+
+        # Own literals override inherited ones, and defaults come from
+        # CapabilityTemplate. Computed values are left to the import.
+        attrs = capabilities['registrytestapp']['attrs']
+        self.assertEqual(attrs['ports'], [8080, 8443])
+        self.assertEqual(attrs['package'], 'registrytest')
+        self.assertEqual(attrs['knobs'], ['appname'])
+        self.assertEqual(attrs['jailable'], True)
+        self.assertIsNone(attrs['memory'])
+        self.assertNotIn('resource_path', attrs)
+
+    def test_manifest_cache(self):
+        manifest = registry.load_manifest(self.plugindir)
+        self.assertEqual(registry.load_manifest(self.plugindir), manifest)
+
+        # Changing a source rebuilds the manifest
+        self.write_plugin(self.plugin+'\nclass registrytestextra(registrytestbase): pass\n')
+        names = [entry['name'] for entry in registry.load_manifest(self.plugindir)['capabilities']]
+        self.assertIn('registrytestextra', names)
+
+    def test_lazy_import(self):
+        registry.add(self.plugindir)
+
+        capcls = registry.lookup('registrytestapp')
+        self.assertIsInstance(capcls, registry.LazyCapability)
+        self.assertIsNone(registry.lookup('registrytesthelper'))
+
+        # Manifest attributes don't import the plugin
+        self.assertEqual(capcls.ports, [8080, 8443])
+        self.assertEqual(capcls.package, 'registrytest')
+        self.assertNotIn('registrytestpkg.caps', sys.modules)
+
+        # Instantiating it does, and replaces the stand-in
+        cap = capcls()
+        self.assertIn('registrytestpkg.caps', sys.modules)
+        self.assertEqual(cap.memory, 1024)
+        self.assertIs(registry.lookup('registrytestapp'), type(cap))
+        self.assertEqual(type(cap).resource_path, 'registrytestpkg.resources')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import subprocess
+import sys
+import types
+import unittest
+sys.path.append('../..')
+
+import frieze
+from frieze.rollout import RollingDeploy
+from openarc.exception import OAError
+
+def host(id_, role=None):
+    return types.SimpleNamespace(id=id_, fqdn=f'host{id_}.test', role=role if role else frieze.HostRole.COMPUTE)
+
+def container(host, deployment, stripe_group, ports=None):
+    return types.SimpleNamespace(
+        host=host,
+        deployment=types.SimpleNamespace(name=deployment),
+        stripe_group=stripe_group,
+        fqdn=f'{stripe_group}.{deployment}.test',
+        ip4=lambda: '10.0.0.1',
+        capability=types.SimpleNamespace(c_capability=types.SimpleNamespace(ports=ports)),
+    )
+
+class FailingRollout(RollingDeploy):
+    """Hosts never answer"""
+    def remote(self, host, id_file, cmd):
+        return subprocess.CompletedProcess(cmd, 1, stdout=b'')
+
+class RecordingRollout(RollingDeploy):
+    """Records pushes and health checks instead of waiting on hosts"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.events = []
+
+    def wait_healthy(self, batch, id_file):
+        self.events.append(('wait', [host.id for (host, boottime, reboots) in batch]))
+
+class TestRollingDeploy(unittest.TestCase):
+    def rollout(self, containers, rolloutcls=RecordingRollout, **kwargs):
+        return rolloutcls(types.SimpleNamespace(containers=containers), **kwargs)
+
+    def push(self, rollout):
+        def push(host, host_tar):
+            rollout.events.append(('push', host.id))
+            return (host, None, False)
+        return push
+
+    def batches(self, rollout, hosts):
+        rollout.run([(host, b'') for host in hosts], self.push(rollout), 'id_file')
+        return [hosts for (event, hosts) in rollout.events if event=='wait']
+
+    def test_stripe_allowance(self):
+        hosts = [host(i) for i in range(1, 5)]
+        containers = [container(h, 'app', 'www') for h in hosts]+[container(hosts[0], 'app', 'db'), container(hosts[1], 'app', 'db')]
+        rollout = self.rollout(containers, max_unavailable=0.5, timeout=1)
+
+        # Half of the four www stripes, but at least one of the two db stripes
+        self.assertEqual(rollout.allowance(('app', 'www')), 2)
+        self.assertEqual(rollout.allowance(('app', 'db')), 1)
+        self.assertEqual(self.batches(rollout, hosts), [[1], [2, 3], [4]])
+
+    def test_bastion_alone(self):
+        hosts = [host(1, frieze.HostRole.SITEBASTION), host(2), host(3), host(4, frieze.HostRole.SITEROUTER), host(5)]
+        rollout = self.rollout([], timeout=1)
+
+        self.assertEqual(self.batches(rollout, hosts), [[1], [2, 3], [4], [5]])
+
+    def test_pushed_before_batch_closes(self):
+        hosts = [host(i) for i in range(1, 6)]
+        rollout = self.rollout([], max_batch=2, timeout=1)
+
+        # Hosts without containers are capped, and each host goes out before
+        # the batch it is in is waited on
+        self.batches(rollout, hosts)
+        self.assertEqual(rollout.events, [
+            ('push', 1), ('push', 2), ('wait', [1, 2]),
+            ('push', 3), ('push', 4), ('wait', [3, 4]),
+            ('push', 5), ('wait', [5]),
+        ])
+
+    def test_unhealthy_batch_stops_rollout(self):
+        hosts = [host(1), host(2)]
+        containers = [container(h, 'app', 'www', ports=[443]) for h in hosts]
+        rollout = self.rollout(containers, rolloutcls=FailingRollout, max_unavailable=0.5, timeout=0.05, interval=0.01)
+
+        pushed = []
+        def push(host, host_tar):
+            pushed.append(host.id)
+            return (host, None, False)
+        with self.assertRaises(OAError):
+            rollout.run([(h, b'') for h in hosts], push, 'id_file')
+        self.assertEqual(pushed, [1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import unittest
+sys.path.append('../..')
+from testhelper import *
+
+import frieze
+frieze.init()
+import frieze.capability
+from frieze.loader import load_domain
+from frieze.snapshot import export_snapshot, load_snapshot
+
+class TestSnapshot(unittest.TestCase, TestBase):
+    def setUp(self):
+        self.setUp_db()
+
+    def tearDown(self):
+        self.tearDown_db()
+
+    topology = {
+        'domain' : {'domain' : 'snapshot.test', 'org' : 'SnapshotTest'},
+        'templates' : {
+            'SmallCompute' : {'cores' : 1, 'memory' : 1024, 'bandwidth' : 1024, 'os' : 'FreeBSD_12_0'},
+        },
+        'sites' : [{
+            'name'      : 'Vultr NY1',
+            'shortname' : 'ny1',
+            'provider'  : 'VULTR',
+            'location'  : 'NY',
+            'hosts'     : [
+                {'template' : 'SmallCompute', 'role' : 'SITEBASTION', 'names' : ['installation01']},
+                {'template' : 'SmallCompute', 'role' : 'COMPUTE',     'names' : ['compute01', 'compute02']},
+            ],
+        }],
+    }
+
+    def test_render_multihost_site(self):
+        snap = load_domain(self.topology).snapshot('snapshot test')
+
+        with tempfile.TemporaryDirectory() as td:
+            loaded = load_snapshot(export_snapshot(snap, os.path.join(td, 'snapshot.json.gz')))
+
+        rendered = [(host.fqdn, host_tar) for (host, host_tar) in loaded.iter_configs()]
+
+        self.assertEqual(len(rendered), 3)
+        self.assertEqual(
+            sorted([fqdn for (fqdn, host_tar) in rendered]),
+            sorted([host.fqdn for site in snap.site for host in site.host])
+        )
+        for (fqdn, host_tar) in rendered:
+            self.assertGreater(len(host_tar), 0)
+
+    class SQL(TestBase.SQL):
+        pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,6 +21,7 @@ setup(name='frieze',
         'boto3',
         'certbot',
         'cryptography',
+        'dnspython',
         'mako',
         'openarc',
         'vultr'